@@ -0,0 +1,111 @@
+#
+# Copyright 2019 D R Graham
+
+import copy
+import os
+import pickle
+import queue
+import tempfile
+import threading
+
+
+def write_pickle(path, obj):
+    """Pickles <obj> to <path> atomically.
+
+    The pickle is written to a temporary file in the same directory and synced to disk, then renamed over <path>, so
+    a crash mid-write leaves the previous contents of <path> intact. The directory is synced after the rename, so the
+    new contents survive a crash too.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(obj, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try: os.remove(tmp_path)
+        except OSError: pass
+        raise
+    _fsync_directory(directory)
+
+
+def _fsync_directory(directory):
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:  # directories cannot be opened on some platforms, e.g. Windows
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class AsyncWriter(object):
+    """Writes pickles with write_pickle on a background thread, so that the configuration procedures do not wait on
+    the disk at their checkpoints.
+
+    Writes are queued in order of submission. The queue is bounded: once max_pending writes are waiting, submit()
+    blocks until the oldest one is done. An error raised by a write is re-raised by the next call to submit(), flush()
+    or close().
+    """
+
+    def __init__(self, max_pending=8):
+        """
+        Args:
+          max_pending: the maximum number of writes waiting in the queue.
+        """
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._errors = []
+        self.num_writes = 0  # writes completed
+        self.num_blocked = 0  # submits that had to wait for the queue to drain
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:  # closed
+                    return
+                path, obj = item
+                try:
+                    write_pickle(path, obj)
+                    self.num_writes += 1
+                except Exception as e:
+                    self._errors.append(e)
+            finally:
+                self._queue.task_done()
+
+    def _raise_errors(self):
+        if self._errors:
+            raise self._errors.pop(0)
+
+    def submit(self, path, obj):
+        """Queues <obj> to be pickled to <path>.
+
+        A shallow copy of <obj> is taken, so the caller may keep appending to a list or updating a dict that it has
+        submitted, but must not modify the objects it contains.
+        """
+        self._raise_errors()
+        snapshot = copy.copy(obj)
+        try:
+            self._queue.put_nowait((path, snapshot))
+        except queue.Full:
+            self.num_blocked += 1
+            self._queue.put((path, snapshot))
+
+    def flush(self):
+        """Waits until every queued write is done."""
+        self._queue.join()
+        self._raise_errors()
+
+    def close(self):
+        """Waits until every queued write is done and stops the background thread."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._raise_errors()
@@ -0,0 +1,245 @@
+#!/usr/bin/python
+#
+# Copyright 2019 D R Graham
+
+import argparse
+import collections
+import itertools
+import os
+import pickle
+import numpy as np
+from simulated_environment import Environment
+from util import to_millis, from_millis
+
+META_FILENAME = 'meta.p'
+
+
+def _block_filename(store_dir, config_block, instance_block):
+    return os.path.join(store_dir, 'block_{}_{}.npy'.format(config_block, instance_block))
+
+
+def write_chunked_store(rows, num_instances, store_dir, configs_per_block=64, instances_per_block=4096, quantize_timeout=None):
+    """Writes runtime measurements to a chunked on-disk store readable by ChunkedEnvironment.
+
+    Args:
+      rows: iterable of per-config runtime lists, in config id order. Rows are
+        consumed one block of configs at a time, so the full measurement matrix
+        never has to be held in memory.
+      num_instances: the number of instances (length of every row).
+      store_dir: directory to write the blocks and metadata into.
+      configs_per_block: number of config rows in each block.
+      instances_per_block: number of instance columns in each block.
+      quantize_timeout: if given, blocks hold uint32 milliseconds (see
+        util.to_millis), with runtimes above this timeout encoded as
+        util.TIMEOUT_SENTINEL.
+
+    Returns:
+      The number of configs written.
+    """
+    try: os.mkdir(store_dir)
+    except OSError: pass
+
+    num_configs = 0
+    config_block = 0
+    buffered = []
+
+    def flush(buffered, config_block):
+        block = np.array(buffered, dtype=np.float64)
+        if quantize_timeout is not None:
+            block = to_millis(block, quantize_timeout)
+        for instance_block, start in enumerate(range(0, num_instances, instances_per_block)):
+            np.save(_block_filename(store_dir, config_block, instance_block), block[:, start:start + instances_per_block])
+
+    for row in rows:
+        if len(row) != num_instances:
+            raise ValueError('row for config {} has {} instances, expected {}'.format(num_configs, len(row), num_instances))
+        buffered.append(row)
+        num_configs += 1
+        if len(buffered) == configs_per_block:
+            flush(buffered, config_block)
+            buffered = []
+            config_block += 1
+    if buffered:
+        flush(buffered, config_block)
+
+    meta = {'num_configs':num_configs,
+            'num_instances':num_instances,
+            'configs_per_block':configs_per_block,
+            'instances_per_block':instances_per_block,
+            'millis':quantize_timeout is not None}
+    with open(os.path.join(store_dir, META_FILENAME), 'wb') as f:
+        pickle.dump(meta, f)
+
+    return num_configs
+
+
+class BlockCache(object):
+    """LRU cache of measurement blocks loaded on demand from a chunked store."""
+
+    def __init__(self, store_dir, max_blocks):
+        """
+        Args:
+          store_dir: directory written by write_chunked_store.
+          max_blocks: the maximum number of blocks kept in memory at once.
+        """
+        with open(os.path.join(store_dir, META_FILENAME), 'rb') as f:
+            meta = pickle.load(f)
+
+        self.store_dir = store_dir
+        self.max_blocks = max_blocks
+        self.num_configs = meta['num_configs']
+        self.num_instances = meta['num_instances']
+        self.configs_per_block = meta['configs_per_block']
+        self.instances_per_block = meta['instances_per_block']
+        self.millis = meta.get('millis', False)
+
+        self._blocks = collections.OrderedDict()  # (config_block, instance_block) -> array, least recently used first
+        self.hits = 0
+        self.misses = 0
+
+    def get_block(self, config_block, instance_block):
+        key = (config_block, instance_block)
+        block = self._blocks.get(key)
+        if block is not None:
+            self.hits += 1
+            self._blocks.move_to_end(key)
+            return block
+
+        self.misses += 1
+        block = np.load(_block_filename(self.store_dir, config_block, instance_block))
+        self._blocks[key] = block
+        if len(self._blocks) > self.max_blocks:
+            self._blocks.popitem(last=False)  # evict least recently used
+        return block
+
+    def get(self, config_id, instance_id):
+        block = self.get_block(config_id // self.configs_per_block, instance_id // self.instances_per_block)
+        value = block[config_id % self.configs_per_block, instance_id % self.instances_per_block]
+        if self.millis:
+            return float(from_millis(value))
+        return float(value)
+
+    def get_row(self, config_id):
+        """Returns the full runtime row for a config. Loads every instance block for that config."""
+        row = []
+        for instance_block in range(0, (self.num_instances + self.instances_per_block - 1) // self.instances_per_block):
+            block = self.get_block(config_id // self.configs_per_block, instance_block)
+            values = block[config_id % self.configs_per_block]
+            row.extend((from_millis(values) if self.millis else values).tolist())
+        return row
+
+
+class _LazyRow(object):
+    """Sequence view of one config's runtimes, backed by a BlockCache."""
+
+    def __init__(self, cache, config_id):
+        self._cache = cache
+        self._config_id = config_id
+
+    def __len__(self):
+        return self._cache.num_instances
+
+    def __getitem__(self, instance_id):
+        return self._cache.get(self._config_id, instance_id)
+
+    def __iter__(self):
+        return iter(self._cache.get_row(self._config_id))
+
+
+class _LazyResults(object):
+    """Sequence of _LazyRow, standing in for the list of lists built by Environment."""
+
+    def __init__(self, cache):
+        self._cache = cache
+
+    def __len__(self):
+        return self._cache.num_configs
+
+    def __getitem__(self, config_id):
+        if not 0 <= config_id < self._cache.num_configs:
+            raise IndexError('config_id out of range: {}'.format(config_id))
+        return _LazyRow(self._cache, config_id)
+
+    def __iter__(self):
+        for config_id in range(self._cache.num_configs):
+            yield _LazyRow(self._cache, config_id)
+
+
+class ChunkedEnvironment(Environment):
+    """Environment that reads measurements on demand from a chunked on-disk store.
+
+    Only the blocks touched by the configuration procedure are loaded, and at
+    most `cache_blocks` of them are resident at any time. Since the procedures
+    only ever run a slowly growing prefix of the instances for each config,
+    most of the measurement matrix is never read.
+    """
+
+    def __init__(self, store_dir, timeout, cache_blocks=256):
+        """
+        Args:
+          store_dir: directory written by write_chunked_store.
+          timeout: the timeout used for the runtime measurements.
+          cache_blocks: the maximum number of blocks to keep in memory.
+        """
+        self._timeout = timeout
+        self._cache = BlockCache(store_dir, cache_blocks)
+        self._results = _LazyResults(self._cache)
+        self._instance_count = self._cache.num_instances
+        self.reset()
+
+    def get_cache(self):
+        return self._cache
+
+
+def read_measurement_stream(path):
+    """Reads the rows of a measurement stream, one config at a time.
+
+    A measurement stream is a file of consecutive pickles, one (key, runtimes) pair per config in increasing key
+    order, the order in which configs of a measurements file are numbered. It can be written as the measurements are
+    collected and converted without loading it whole.
+
+    Yields:
+      The runtime list of each config, in config id order.
+    """
+    last_key = None
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                key, runtimes = pickle.load(f)
+            except EOFError:
+                return
+            if last_key is not None and not last_key < key:
+                raise ValueError('{}: config {} follows config {}, keys must be increasing'.format(path, key, last_key))
+            last_key = key
+            yield runtimes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Converts a measurements file into a chunked store for ChunkedEnvironment.')
+    parser.add_argument('--measurements-filename', help='Filename to load measurement results from; the whole file is loaded into memory', type=str, default='measurements.dump')
+    parser.add_argument('--measurements-stream', help='Measurement stream to convert one config at a time instead of --measurements-filename (see read_measurement_stream)', type=str, default=None)
+    parser.add_argument('--store-dir', help='Directory to write the chunked store into', type=str, default='measurements_store')
+    parser.add_argument('--configs-per-block', help='Number of configs in each block', type=int, default=64)
+    parser.add_argument('--instances-per-block', help='Number of instances in each block', type=int, default=4096)
+    parser.add_argument('--quantize-timeout', help='Store runtimes as uint32 milliseconds, with runtimes above this timeout (seconds) marked as timeouts', type=float, default=None)
+    args = vars(parser.parse_args())
+
+    if args['measurements_stream'] is not None:
+        rows = read_measurement_stream(args['measurements_stream'])
+        first_row = next(rows, None)
+        if first_row is None:
+            raise ValueError('{} holds no measurements'.format(args['measurements_stream']))
+        num_instances = len(first_row)
+        rows = itertools.chain([first_row], rows)
+    else:
+        with open(args['measurements_filename'], 'rb') as f:
+            results = pickle.load(f)
+        rows = (results[k] for k in sorted(results.keys()))
+        num_instances = len(next(iter(results.values())))
+
+    num_configs = write_chunked_store(rows, num_instances, args['store_dir'], args['configs_per_block'], args['instances_per_block'], args['quantize_timeout'])
+    print('wrote {} configs x {} instances to {}'.format(num_configs, num_instances, args['store_dir']))
+
+
+if __name__ == '__main__':
+    main()
@@ -5,13 +5,447 @@ from collections import deque
 from math import ceil, floor, log, sqrt
 import numpy as np
 import bisect
+import heapq
+from array import array
+from util import millis
 
+_UNSEEN = 0xFFFFFFFF  # marks instances without a runtime in RuntimeMultiset
 
-class ConfigurationTester():
+
+class RuntimeMultiset(object):
+    """
+    Multiset of the most recent capped runtime of each instance, in integer milliseconds, kept as a sorted list of
+    unique values with counts.
+    """
+
+    __slots__ = ('instance_runtimes_capped', 'num_instances', 'unique_values', 'unique_value_counts')
+
+    def __init__(self):
+        self.instance_runtimes_capped = array('I')  # most recent capped runtime (ms) of each instance, indexed by instance id
+        self.num_instances = 0  # number of instances with a runtime
+        self.unique_values = []  # sorted list of unique runtime values seen
+        self.unique_value_counts = {}
+
+
+    def __len__(self):
+        return self.num_instances
+
+
+    def update(self, instance_id, new_ms):
+        """
+        Maintains the sorted list of unique runtime values and their counts.
+        """
+        runtimes = self.instance_runtimes_capped
+        if instance_id >= len(runtimes):
+            runtimes.extend([_UNSEEN] * (instance_id + 1 - len(runtimes)))
+
+        old_ms = runtimes[instance_id]
+        if old_ms == _UNSEEN:
+            self.num_instances += 1
+        elif self.unique_value_counts[old_ms] > 1:
+            self.unique_value_counts[old_ms] -= 1
+        else:  # remove rt from unique values
+            del self.unique_values[bisect.bisect_left(self.unique_values, old_ms)]
+            del self.unique_value_counts[old_ms]
+
+        runtimes[instance_id] = new_ms
+        if new_ms in self.unique_value_counts:
+            self.unique_value_counts[new_ms] += 1
+        else:
+            bisect.insort(self.unique_values, new_ms)
+            self.unique_value_counts[new_ms] = 1
+
+
+def beta(p, r, t):
+    """
+    Implementation of Beta function from paper, for a config with r active instances at iteration t.
+    """
+    _t = max(t, 1)  # setting initial values so that we don't take log of 0
+    _r = max(r, 1)
+    k = floor(log(1 / p, 2))
+    if k == 0:
+        eps = sqrt(9. * log(_t) / _r)
+    else:
+        eps = sqrt(9 * 2 ** k * log(k * _t) / _r)
+    if eps <= 0.5:
+        return p / (1 + eps)
+    else:
+        return 0.
+
+
+def _beta_eps(p, r, t):
+    """
+    The relative error used by the Beta function from the paper (see beta).
+    """
+    _t = max(t, 1)  # setting initial values so that we don't take log of 0
+    _r = max(r, 1)
+    k = floor(log(1 / p, 2))
+    if k == 0:
+        return sqrt(9. * log(_t) / _r)
+    else:
+        return sqrt(9 * 2 ** k * log(k * _t) / _r)
+
+
+def beta_upper(p, r, t):
+    """
+    Upper counterpart of the Beta function: a high-probability upper bound on a tail probability estimated as p.
+    """
+    eps = _beta_eps(p, r, t)
+    if eps <= 0.5:
+        return min(p * (1 + eps), 1.)
+    else:
+        return 1.
+
+
+def _confidence_bound(runtimes, r, t, beta_fn):
+    n = len(runtimes)
+    unique_values = runtimes.unique_values
+    unique_value_counts = runtimes.unique_value_counts
+    ecdf = []  # empirical cumulative distribution of runtime values
+    bound = 0.
+    for i in range(len(unique_values)):
+        rt = unique_values[i]
+        if i == 0:
+            rt_low = 0.
+            ecdf.append(unique_value_counts[rt] / n)
+            g = 0.
+        else:
+            rt_low = unique_values[i - 1]
+            ecdf.append(ecdf[i - 1] + unique_value_counts[rt] / n)
+            g = ecdf[i - 1]
+
+        bound += (rt - rt_low) * beta_fn(1. - g, r, t)
+
+    return bound / 1000.  # runtimes are in milliseconds
+
+
+def compute_confidence_bound(runtimes, r, t):
+    """
+    Compute the lcb from the paper, for a config with runtime multiset <runtimes> and r active instances.
+    """
+    if len(runtimes) == 0:  # if no runtime values, prioritize this config
+        return -1e-6
+    return _confidence_bound(runtimes, r, t, beta)
+
+
+def compute_upper_confidence_bound(runtimes, r, t, cap=None, timed_out=()):
+    """
+    Compute an upper confidence bound on the mean runtime of a config capped at <cap> seconds (by default, at the
+    largest runtime in <runtimes>). The values in <runtimes> must be actual runtimes, except for the instances in
+    <timed_out>, whose runs were cut off by a timeout: these are counted at <cap>, which bounds their capped runtime
+    from above. Where <cap> is above every runtime seen, the probability of a runtime above the largest one is bounded
+    by 9 log(t) / r, which holds with probability at least 1 - t^-9.
+    """
+    n = len(runtimes)
+    if n == 0:
+        return float('inf')
+    unique_values = runtimes.unique_values
+    unique_value_counts = runtimes.unique_value_counts
+    cap_ms = unique_values[-1] if cap is None else millis(cap)
+    if timed_out:
+        unique_value_counts = dict(unique_value_counts)
+        for l in timed_out:
+            unique_value_counts[runtimes.instance_runtimes_capped[l]] -= 1
+        unique_value_counts[cap_ms] = unique_value_counts.get(cap_ms, 0) + len(timed_out)
+        unique_values = sorted(rt for rt, count in unique_value_counts.items() if count > 0)
+    bound = 0.
+    rt_low = 0.
+    g = 0.  # empirical probability of a runtime of at most rt_low
+    for rt in unique_values:
+        if rt >= cap_ms:
+            return (bound + (cap_ms - rt_low) * beta_upper(1. - g, r, t)) / 1000.  # runtimes are in milliseconds
+        bound += (rt - rt_low) * beta_upper(1. - g, r, t)
+        g += unique_value_counts[rt] / n
+        rt_low = rt
+    tail = min(9. * log(max(t, 1)) / max(r, 1), 1.)
+    return (bound + (cap_ms - rt_low) * tail) / 1000.
+
+
+def compute_confidence_bounds(runtimes_list, r_list, t):
+    """
+    Compute the lcbs of several configs in one batched pass. Gives the same values as calling
+    compute_confidence_bound on each config in turn.
+    """
+    m = len(runtimes_list)
+    lcbs = np.full(m, -1e-6)  # if no runtime values, prioritize the config
+    rows = [j for j in range(m) if len(runtimes_list[j]) > 0]
+    if not rows:
+        return lcbs
+
+    width = max(len(runtimes_list[j].unique_values) for j in rows)
+    values = np.zeros((len(rows), width))
+    counts = np.zeros((len(rows), width))
+    mask = np.zeros((len(rows), width), dtype=bool)
+    n = np.empty((len(rows), 1))
+    _r = np.empty((len(rows), 1))
+    for row, j in enumerate(rows):
+        runtimes = runtimes_list[j]
+        unique_values = runtimes.unique_values
+        num_values = len(unique_values)
+        values[row, :num_values] = unique_values
+        counts[row, :num_values] = [runtimes.unique_value_counts[rt] for rt in unique_values]
+        mask[row, :num_values] = True
+        n[row] = len(runtimes)
+        _r[row] = max(r_list[j], 1)
+    _t = max(t, 1)  # setting initial values so that we don't take log of 0
+
+    ecdf = np.cumsum(counts / n, axis=1)  # empirical cumulative distribution of runtime values
+    g = np.zeros_like(ecdf)
+    g[:, 1:] = ecdf[:, :-1]
+    values_low = np.zeros_like(values)
+    values_low[:, 1:] = values[:, :-1]
+
+    p = np.where(mask, 1. - g, 1.)  # padding beyond a config's unique values is ignored
+    k = np.floor(np.log(1 / p) / log(2))
+    with np.errstate(divide='ignore', invalid='ignore'):  # log(k * _t) is not used where k == 0
+        eps = np.where(k == 0, np.sqrt(9. * log(_t) / _r), np.sqrt(9 * 2 ** k * np.log(k * _t) / _r))
+    beta_values = np.where(eps <= 0.5, p / (1 + eps), 0.)
+
+    terms = np.where(mask, (values - values_low) * beta_values, 0.)
+    lcbs[rows] = np.cumsum(terms, axis=1)[:, -1] / 1000.  # sequential sum, as in compute_confidence_bound
+    return lcbs
+
+
+class AdaptiveLcbRefreshPolicy(object):
+    """
+    Adapts each ConfigurationTester's update_lcb_every to how much its lcb moves between refreshes.
+
+    Between executions a config's lcb never increases as t grows: it falls smoothly as the Beta terms shrink, and in
+    jumps as terms reach zero: the term for a tail probability p once 9 2^k log(k t) / r > 1 / 4, with
+    k = floor(log2(1 / p)) (9 log(t) / r > 1 / 4 for k = 0). A config whose lcb has reached zero keeps it
+    until it is next executed, so it is refreshed only every max_every iterations. For other configs the policy
+    extrapolates the rate at which the lcb fell since the last refresh; if, at twice that rate, the lcb would stay
+    above margin times the current minimum lcb for a doubled interval, and none of its terms would reach zero within
+    it, the interval is doubled (up to max_every). Otherwise, and whenever the config is executed, it returns to base_every.
+    """
+
+    def __init__(self, base_every=1000, max_every=64000, margin=1.5):
+        """
+        Parameters:
+            base_every : refresh interval for configs near the minimum lcb, drifting, or just executed
+            max_every : largest refresh interval for any config
+            margin : configs must stay above margin times the minimum lcb to have their interval increased
+        """
+        self.base_every = base_every
+        self.max_every = max_every
+        self.margin = margin
+
+
+    def update(self, tester, old_lcb, new_lcb, t, elapsed, min_lcb):
+        """
+        Sets tester.update_lcb_every after its lcb was refreshed from old_lcb to new_lcb at iteration t, <elapsed>
+        iterations after its previous update.
+        """
+        if new_lcb == 0. and len(tester.runtimes) > 0:  # lcb >= 0, so it stays at zero until the next execution
+            tester.update_lcb_every = self.max_every
+            return
+        rate = max(old_lcb - new_lcb, 0.) / max(elapsed, 1)  # drift per iteration
+        every = min(2 * tester.update_lcb_every, self.max_every)
+        if (new_lcb > 0 and new_lcb - 2. * rate * every > self.margin * max(min_lcb, 0.)
+                and not self._term_vanishes(tester, t, t + every + 1)):
+            tester.update_lcb_every = every
+        else:
+            tester.update_lcb_every = self.base_every
+
+
+    def _term_vanishes(self, tester, t, t_next):
+        """
+        Whether a Beta term of the tester's lcb that is non-zero at iteration t reaches zero by iteration t_next. A term
+        depends on its tail probability p only through k = floor(log2(1 / p)), so each k present is checked once.
+        """
+        runtimes = tester.runtimes
+        n = len(runtimes)
+        tails = {}  # k -> a tail probability with that k
+        g = 0.
+        for rt in runtimes.unique_values:
+            p = 1. - g
+            tails.setdefault(floor(log(1 / p, 2)), p)
+            g += runtimes.unique_value_counts[rt] / n
+        for p in tails.values():
+            if _beta_eps(p, tester.r, t) <= 0.5 < _beta_eps(p, tester.r, t_next):
+                return True
+        return False
+
+
+    def reset(self, tester):
+        """
+        Returns the tester to the base interval, e.g. after it was executed.
+        """
+        tester.update_lcb_every = self.base_every
+
+
+class LcbRefreshScheduler(object):
+    """
+    Refreshes the lcbs of ConfigurationTesters in batches, rather than lazily one config at a time.
+
+    A tester's lcb is due for a refresh once more than its update_lcb_every iterations have elapsed since it was last
+    updated. Since configs tend to be updated in lockstep, refreshes come in bursts; the scheduler groups all configs
+    that are due at an iteration and re-computes their lcbs with one call to compute_confidence_bounds. An optional
+    AdaptiveLcbRefreshPolicy adjusts each tester's refresh interval after every refresh, in which case executed()
+    must be called after each tester is executed.
+    """
+
+    def __init__(self, testers, policy=None):
+        """
+        Parameters:
+            testers : dict mapping config ids to ConfigurationTesters
+            policy : optional AdaptiveLcbRefreshPolicy
+        """
+        self.testers = testers
+        self.policy = policy
+        self.num_refreshes = 0  # total number of lcbs re-computed by the scheduler
+        self.heap = []  # (iteration the tester is next due, cid)
+        self.scheduled = {}  # cid -> iteration of its live heap entry; other entries for the cid are stale
+        for cid in testers:
+            self.add(cid)
+
+
+    def add(self, cid):
+        """
+        Start scheduling refreshes for the tester with id <cid>.
+        """
+        self._schedule(cid, self._due(self.testers[cid]))
+
+
+    def executed(self, cid):
+        """
+        Lets the policy know that the tester with id <cid> was executed, so that its lcb may have moved.
+        """
+        if self.policy is not None:
+            tester = self.testers[cid]
+            self.policy.reset(tester)
+            due = self._due(tester)
+            if due < self.scheduled[cid]:
+                self._schedule(cid, due)
+
+
+    def _schedule(self, cid, due):
+        self.scheduled[cid] = due
+        heapq.heappush(self.heap, (due, cid))
+
+
+    def _due(self, tester):
+        return tester.t_last_update_lcb + tester.update_lcb_every + 1
+
+
+    def refresh_due(self, t, min_lcb=None):
+        """
+        Re-computes the lcb of every tester that is due at iteration t. min_lcb is the current minimum lcb over all
+        testers, used by the policy. Returns the number of testers refreshed.
+        """
+        due = []
+        while self.heap and self.heap[0][0] <= t:
+            entry_due, cid = heapq.heappop(self.heap)
+            tester = self.testers.get(cid)
+            if tester is None or self.scheduled.get(cid) != entry_due:  # no longer scheduled, or superseded
+                continue
+            next_due = self._due(tester)
+            if next_due > t:  # updated since the entry was pushed
+                self._schedule(cid, next_due)
+            else:
+                due.append(tester)
+
+        if due:
+            lcbs = compute_confidence_bounds([tester.runtimes for tester in due], [tester.r for tester in due], t)
+            for tester, lcb in zip(due, lcbs.tolist()):
+                if self.policy is not None and min_lcb is not None:
+                    self.policy.update(tester, tester.lcb, lcb, t, t - tester.t_last_update_lcb, min_lcb)
+                tester.lcb = lcb
+                tester.t_last_update_lcb = t
+                self._schedule(tester.cid, self._due(tester))
+            self.num_refreshes += len(due)
+        return len(due)
+
+
+    def next_free_task(self, t, busy):
+        """
+        For running several testers at once: refreshes the testers due at iteration t, then takes the next task of the
+        tester with the smallest lcb among those whose ids are not in the set <busy>, and adds its id to <busy>.
+        Returns (cid, instance_id, theta), or None if every tester is busy.
+        """
+        self.refresh_due(t)
+        candidates = [(cid, tester.get_confidence_bound(t)) for cid, tester in self.testers.items() if cid not in busy]
+        if not candidates:
+            return None
+        cid, _ = min(candidates, key=lambda c: c[1])
+        l, theta = self.testers[cid].next_task()
+        busy.add(cid)
+        return cid, l, theta
+
+
+class IncumbentTracker(object):
+    """
+    Maintains the incumbent (the config with the most active instances) and per-config vectors of r and runtime, so
+    that checkpoints need not scan every ConfigurationTester. Configs can be added over time.
     """
 
+    def __init__(self, n):
+        """
+        Parameters:
+            n : number of configs, with ids 0 to n - 1, to track from the start
+        """
+        self.cids = list(range(n))  # config id of each slot in the vectors
+        self.slots = dict((cid, cid) for cid in range(n))
+        self.r = np.zeros(max(n, 1), dtype=np.int64)  # number of active instances per config
+        self.total_time = np.zeros(max(n, 1))  # runtime, with resuming, per config
+        self.best_cid = 0 if n > 0 else None
+        self.best_r = 0
+
+
+    def add(self, cid):
+        """
+        Start tracking the config with id <cid>.
+        """
+        slot = len(self.cids)
+        if slot == len(self.r):  # double the capacity of the vectors
+            self.r = np.concatenate([self.r, np.zeros_like(self.r)])
+            self.total_time = np.concatenate([self.total_time, np.zeros_like(self.total_time)])
+        self.cids.append(cid)
+        self.slots[cid] = slot
+        self.update(cid, 0, 0.)
+
+
+    def update(self, cid, r, total_time):
+        """
+        Records the state of config <cid> after it was executed. Since r never decreases, the incumbent only changes
+        when <cid> overtakes it. Ties go to the smallest id, as for max() over a dict of ConfigurationTesters.
+        """
+        slot = self.slots[cid]
+        self.r[slot] = r
+        self.total_time[slot] = total_time
+        if self.best_cid is None or r > self.best_r or (r == self.best_r and cid < self.best_cid):
+            self.best_cid = cid
+            self.best_r = r
+
+
+    def get_incumbent(self):
+        """
+        Returns the id of the incumbent and its number of active instances.
+        """
+        return self.best_cid, self.best_r
+
+
+    def snapshot_r(self):
+        """
+        Returns a list of (cid, r) pairs for all configs.
+        """
+        return list(zip(self.cids, self.r[:len(self.cids)].tolist()))
+
+
+    def snapshot_total_time(self):
+        """
+        Returns a list of (cid, runtime) pairs for all configs.
+        """
+        return list(zip(self.cids, self.total_time[:len(self.cids)].tolist()))
+
+
+class ConfigurationTester(object):
+    """
+    State of Structured Procrastination with Confidence for a single configuration.
     """
 
+    __slots__ = ('cid', 'theta', 'r', 'q', 'Q', 'theta_multiplier', 'runtimes', 'total_time', 'lcb', 'update_lcb_every', 't_last_update_lcb')
+
     def __init__(self, cid, k0, theta_multiplier, update_lcb_every=1000):
         """
         Parameters:
@@ -28,9 +462,7 @@ class ConfigurationTester():
         self.Q = deque()  # double ended queue
         self.theta_multiplier = theta_multiplier
 
-        self.instance_runtimes_capped = {}  # mapping from instances to most recent capped runtime
-        self.unique_values = []  # sorted list of unique runtime values seen
-        self.unique_value_counts = {}
+        self.runtimes = RuntimeMultiset()  # most recent capped runtime of each instance
 
         self.total_time = 0  # time spent runing this configuration
 
@@ -44,6 +476,17 @@ class ConfigurationTester():
         Execute one step of the algorithm for this configuration.
         """
 
+        l, theta = self.next_task()
+
+        did_timeout, elapsed, resumed_elapsed = env.run(config_id=self.cid, timeout=theta, instance_id=l)  # get the runtime of config <cid> in instance <l>
+
+        return self.record_result(l, theta, did_timeout, elapsed, t)
+
+
+    def next_task(self):
+        """
+        Returns the (instance, runtime cap) to run next for this configuration.
+        """
         if len(self.Q) < self.q:
             self.r += 1
             l = self.r
@@ -51,11 +494,16 @@ class ConfigurationTester():
             l, theta = self.Q.pop()
             self.theta = theta
 
-        did_timeout, elapsed, resumed_elapsed = env.run(config_id=self.cid, timeout=self.theta, instance_id=l)  # get the runtime of config <cid> in instance <l>
+        return l, self.theta
 
+
+    def record_result(self, l, theta, did_timeout, elapsed, t):
+        """
+        Updates the state of this configuration with the outcome of running instance <l> with runtime cap <theta>.
+        """
         if did_timeout:
-            rt = self.theta
-            self.Q.appendleft((l, self.theta_multiplier * self.theta))
+            rt = theta
+            self.Q.appendleft((l, self.theta_multiplier * theta))
         else:
             rt = elapsed
 
@@ -73,32 +521,22 @@ class ConfigurationTester():
         else:
             self.q = ceil(25. * log(t * log(self.r, 2), 2))
 
-        return did_timeout, rt, self.lcb, len(self.instance_runtimes_capped)
+        return did_timeout, rt, self.lcb, len(self.runtimes)
 
 
     def _compute_confidence_bound(self, t):
         """
         Compute the lcb from the paper.
         """
-        n = len(self.instance_runtimes_capped)
-        if n == 0:  # if no runtime values, prioritize this config
-            return -1e-6
-        ecdf = []  # empirical cumulative distribution of runtime values
-        lcb = 0.
-        for i in range(len(self.unique_values)):
-            rt = self.unique_values[i]
-            if i == 0:
-                rt_low = 0.
-                ecdf.append(self.unique_value_counts[rt] / n)
-                g = 0.
-            else:
-                rt_low = self.unique_values[i - 1]
-                ecdf.append(ecdf[i - 1] + self.unique_value_counts[rt] / n)
-                g = ecdf[i - 1]
+        return compute_confidence_bound(self.runtimes, self.r, t)
 
-            lcb += (rt - rt_low) * self.beta(1. - g, t)
 
-        return lcb
+    def _compute_upper_confidence_bound(self, t, cap=None):
+        """
+        Compute an upper confidence bound on the mean runtime of this config, capped at <cap> (see
+        compute_upper_confidence_bound). The instances queued in Q after timing out are counted at <cap>.
+        """
+        return compute_upper_confidence_bound(self.runtimes, self.r, t, cap, [l for l, _ in self.Q])
 
 
     def get_confidence_bound(self, t):
@@ -115,17 +553,7 @@ class ConfigurationTester():
         """
         Implementation of Beta function from paper.
         """
-        _t = max(t, 1)  # setting initial values so that we don't take log of 0
-        _r = max(self.r, 1)
-        k = floor(log(1 / p, 2))
-        if k == 0:
-            eps = sqrt(9. * log(_t) / _r)
-        else:
-            eps = sqrt(9 * 2 ** k * log(k * _t) / _r)
-        if eps <= 0.5:
-            return p / (1 + eps)
-        else:
-            return 0.
+        return beta(p, self.r, t)
 
 
     def get_num_active(self):
@@ -135,38 +563,21 @@ class ConfigurationTester():
         return self.r
 
 
-    def _update_runtime_values(self, instance_id, new_rt, eps=1e-6):
+    def remap_instances(self, remap):
         """
-        Maintains the sorted list of unique runtime values and their counts.
+        Renames instance l to remap(l) in the runtimes and the queue of timed-out instances, e.g. after instances were
+        added to the environment. remap must not map two instances to the same id.
         """
+        runtimes = RuntimeMultiset()
+        for l, ms in enumerate(self.runtimes.instance_runtimes_capped):
+            if ms != _UNSEEN:
+                runtimes.update(remap(l), ms)
+        self.runtimes = runtimes
+        self.Q = deque((remap(l), theta) for l, theta in self.Q)
 
-        if instance_id in self.instance_runtimes_capped:
-            old_rt = self.instance_runtimes_capped[instance_id]
-            rt_count = self.unique_value_counts[old_rt]
-            if rt_count > 1:
-                self.unique_value_counts[old_rt] -= 1
-            else:  # remove rt from unique values
-                delete_ind = bisect.bisect_left(self.unique_values, old_rt)
-                del self.unique_values[delete_ind]
-                del self.unique_value_counts[old_rt]
-
-        insert_ind = bisect.bisect_left(self.unique_values, new_rt)  # get new insert index
-        n = len(self.unique_values)
-
-        if insert_ind < n:  # insert a new value
-            if abs(self.unique_values[insert_ind] - new_rt) > eps:  # sufficiently different from other unique values
-                self.instance_runtimes_capped[instance_id] = new_rt  # save/update runtime value for this instance with new theta
-                bisect.insort(self.unique_values, new_rt)
-                self.unique_value_counts[new_rt] = 1
-            else:
-                self.instance_runtimes_capped[instance_id] = self.unique_values[insert_ind]
-                self.unique_value_counts[self.unique_values[insert_ind]] += 1
-        else:  # new_value is greater than all existing unique_values
-            if n == 0 or abs(self.unique_values[n - 1] - new_rt) > eps:  # first value or sufficiently different from largest unique value
-                self.instance_runtimes_capped[instance_id] = new_rt
-                self.unique_values.append(new_rt)
-                self.unique_value_counts[new_rt] = 1
-            else:
-                self.instance_runtimes_capped[instance_id] = self.unique_values[n - 1]
-                self.unique_value_counts[self.unique_values[n - 1]] += 1
 
+    def _update_runtime_values(self, instance_id, new_rt):
+        """
+        Maintains the sorted list of unique runtime values and their counts.
+        """
+        self.runtimes.update(instance_id, millis(new_rt))
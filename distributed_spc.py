@@ -0,0 +1,289 @@
+#!/usr/bin/python
+#
+# Copyright 2019 D R Graham
+
+import argparse
+import collections
+import multiprocessing
+import os
+import threading
+import time
+from multiprocessing.connection import Listener, Client, wait
+import numpy as np
+import simulated_environment
+from configuration_tester import ConfigurationTester, LcbRefreshScheduler, IncumbentTracker
+from structured_procrastination_confidence import save_results
+from util import format_runtime, day_in_seconds
+
+# Messages are tuples sent with multiprocessing.connection, which pickles them:
+#   worker -> coordinator: ('request', max_tasks, results), results a list of (task_id, did_timeout, elapsed)
+#   coordinator -> worker: ('tasks', tasks), tasks a list of (task_id, config_id, instance_id, theta)
+#   coordinator -> worker: ('stop',)
+
+
+class Coordinator(object):
+    """Owns the ConfigurationTesters of Structured Procrastination with Confidence and leases their runs to workers.
+
+    Each config has at most one run leased at a time; free configs are leased in order of increasing lcb. Workers
+    return their results in batches along with each request for more tasks. Each worker has its own environment, so
+    the coordinator tracks how long each config has run on each instance itself, to count the resumed runtime of runs
+    that continue an earlier capped run on another worker. The leases of a worker that disconnects, or that has not
+    answered a batch within lease_timeout seconds on top of the sum of the batch's runtime caps, are re-queued and
+    handed to the next worker to ask.
+    """
+
+    def __init__(self, n, k0, theta_multiplier, stop_times, lease_timeout=600.):
+        """
+        Args:
+          n: the number of configs.
+          k0: kappa 0.
+          theta_multiplier: how much to increase theta by after timing out.
+          stop_times: total runtimes at which to save results; the run ends at the last one.
+          lease_timeout: seconds, beyond the runtime caps of its batch, after
+            which an unanswered lease is re-queued.
+        """
+        self.configs = dict((i, ConfigurationTester(i, k0, theta_multiplier)) for i in range(n))
+        self.scheduler = LcbRefreshScheduler(self.configs)
+        self.tracker = IncumbentTracker(n)
+        self.stop_times = stop_times
+        self.lease_timeout = lease_timeout
+
+        self.iter_count = 0
+        self.time_so_far = 0.
+        self.total_resumed_runtime = 0.
+        self.runtime_per_config = np.zeros(n)
+        self.ran_so_far = [{} for _ in range(n)]  # longest run so far of each config, by instance
+        self.stage = 0  # index of the next stop time
+
+        self.leases = {}  # task_id -> (config_id, instance_id, theta, connection, time the lease expires)
+        self.busy = set()  # configs with a leased or re-queued run
+        self.requeued = collections.deque()  # (config_id, instance_id, theta) of runs lost with their worker
+        self.next_task_id = 0
+
+        self.results = []
+        self.configs_r = []
+        self.configs_total_time = []
+
+    def is_done(self):
+        return self.stage >= len(self.stop_times)
+
+    def lease(self, conn, max_tasks):
+        """Returns up to max_tasks new tasks for the worker on <conn>."""
+        tasks = []
+        while len(tasks) < max_tasks:
+            if self.requeued:
+                cid, l, theta = self.requeued.popleft()
+            else:
+                task = self.scheduler.next_free_task(self.iter_count, self.busy)
+                if task is None:
+                    break
+                cid, l, theta = task
+            tasks.append((self.next_task_id, cid, l, theta))
+            self.next_task_id += 1
+        # the worker runs the batch in turn and only answers once it is done
+        expires = float('inf')
+        if self.lease_timeout is not None:
+            expires = time.time() + sum(theta for _, _, _, theta in tasks) + self.lease_timeout
+        for task_id, cid, l, theta in tasks:
+            self.leases[task_id] = (cid, l, theta, conn, expires)
+        return tasks
+
+    def record(self, results):
+        """Records a batch of results returned by a worker. Results for leases no longer held are ignored."""
+        for task_id, did_timeout, elapsed in results:
+            lease = self.leases.pop(task_id, None)
+            if lease is None or self.is_done():
+                continue
+            cid, l, theta, _, _ = lease
+            config = self.configs[cid]
+            _, rt, _, _ = config.record_result(l, theta, did_timeout, elapsed, self.iter_count)
+            self.busy.discard(cid)
+            self.time_so_far += rt
+            resumed_elapsed = elapsed - self.ran_so_far[cid].get(l, 0.)
+            self.ran_so_far[cid][l] = elapsed
+            self.total_resumed_runtime += resumed_elapsed
+            self.runtime_per_config[cid] += resumed_elapsed
+            self.tracker.update(cid, config.r, self.runtime_per_config[cid])
+            self.iter_count += 1
+            self.checkpoint()
+
+    def checkpoint(self):
+        while not self.is_done() and self.time_so_far >= self.stop_times[self.stage]:
+            i_star, i_star_r = self.tracker.get_incumbent()
+            print("------- cpu_days_so_far={}, iter_count={},  best_config_id={}, best_config_r={}, leases={}, saving results -------".format(int(self.time_so_far / day_in_seconds), self.iter_count, i_star, i_star_r, len(self.leases)))
+            self.results.append({'iterations':self.iter_count,
+                                 'best_config':i_star,
+                                 'best_config_theta':self.configs[i_star].theta,
+                                 'best_config_r':i_star_r,
+                                 'best_config_q':self.configs[i_star].q,
+                                 'total_runtime':self.time_so_far,
+                                 'total_resumed_runtime':self.total_resumed_runtime})
+            self.configs_r.append(self.tracker.snapshot_r())
+            self.configs_total_time.append(self.tracker.snapshot_total_time())
+            save_results(self.results, self.configs_r, self.configs_total_time)
+            self.stage += 1
+
+    def release(self, conn=None, now=None):
+        """Re-queues the leases held by <conn>, or those that expired before time <now>."""
+        lost = [task_id for task_id, lease in self.leases.items() if lease[3] is conn or (now is not None and lease[4] < now)]
+        for task_id in sorted(lost):
+            cid, l, theta, _, _ = self.leases.pop(task_id)
+            self.requeued.append((cid, l, theta))
+        return len(lost)
+
+    def serve(self, address, authkey, poll_interval=1.):
+        """Serves workers until the last stop time is reached and every worker has been told to stop.
+
+        Returns:
+          The index of the best config.
+        """
+        listener = Listener(address, authkey=authkey)
+        pending = collections.deque()  # connections accepted but not yet served
+
+        def accept():
+            while not listener_closed.is_set():
+                try:
+                    pending.append(listener.accept())
+                except (OSError, EOFError, multiprocessing.AuthenticationError):  # listener closed, or a client failed to authenticate
+                    pass
+
+        listener_closed = threading.Event()
+        acceptor = threading.Thread(target=accept)
+        acceptor.daemon = True
+        acceptor.start()
+
+        conns = []
+        served = False
+        while not (self.is_done() and served and not conns):
+            while pending:
+                conns.append(pending.popleft())
+                served = True
+            for conn in wait(conns, timeout=poll_interval) if conns else []:
+                try:
+                    message = conn.recv()
+                except (EOFError, OSError):  # lost worker
+                    conns.remove(conn)
+                    lost = self.release(conn=conn)
+                    print('lost a worker, re-queued {} leases'.format(lost))
+                    continue
+                _, max_tasks, results = message
+                self.record(results)
+                if self.is_done():
+                    conn.send(('stop',))
+                    conns.remove(conn)
+                    conn.close()
+                else:
+                    conn.send(('tasks', self.lease(conn, max_tasks)))
+            if not conns:
+                time.sleep(poll_interval / 10.)
+            if self.lease_timeout is not None:
+                lost = self.release(now=time.time())
+                if lost:
+                    print('re-queued {} expired leases'.format(lost))
+
+        listener_closed.set()
+        listener.close()
+        while pending:  # workers that connected after the end
+            conn = pending.popleft()
+            conn.send(('stop',))
+            conn.close()
+        i_star, _ = self.tracker.get_incumbent()
+        return i_star
+
+
+def run_worker(address, authkey, env, batch_size=16, connect_timeout=60.):
+    """Runs tasks leased by a Coordinator on <env> until told to stop. Returns the number of runs performed."""
+    deadline = time.time() + connect_timeout
+    while True:  # the coordinator may not be listening yet
+        try:
+            conn = Client(address, authkey=authkey)
+            break
+        except ConnectionRefusedError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+    num_runs = 0
+    results = []
+    while True:
+        conn.send(('request', batch_size, results))
+        message = conn.recv()
+        if message[0] == 'stop':
+            break
+        results = []
+        for task_id, config_id, instance_id, theta in message[1]:
+            did_timeout, elapsed, _ = env.run(config_id=config_id, timeout=theta, instance_id=instance_id)
+            results.append((task_id, did_timeout, elapsed))
+        num_runs += len(results)
+        if not results:  # every config is leased; wait for other workers to report back
+            time.sleep(0.01)
+    conn.close()
+    return num_runs
+
+
+def _local_worker(address, authkey, args):
+    run_worker(address, authkey, simulated_environment.make_environment(args), args['batch_size'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Executes Structured Procrastination with Confidence with a coordinator leasing runs to workers over sockets.')
+    parser.add_argument('--role', help='Whether to run the coordinator or a worker', choices=['coordinator', 'worker'], default='coordinator')
+    parser.add_argument('--host', help='Host the coordinator listens on', type=str, default='localhost')
+    parser.add_argument('--port', help='Port the coordinator listens on', type=int, default=6011)
+    parser.add_argument('--authkey', help='Shared secret used to authenticate workers; required unless the coordinator listens on localhost for --local-workers only', type=str, default=None)
+    parser.add_argument('--local-workers', help='Number of worker processes to start on this machine alongside the coordinator', type=int, default=0)
+    parser.add_argument('--batch-size', help='Number of tasks a worker leases at once', type=int, default=16)
+    parser.add_argument('--lease-timeout', help='Seconds, on top of the sum of the runtime caps of its batch, after which an unanswered lease is re-queued', type=float, default=600.)
+    parser.add_argument('--k0', help='Kappa_0 from the paper', type=float, default=1.)
+    parser.add_argument('--theta-multiplier', help='Theta multiplier from the paper', type=float, default=2.)
+    simulated_environment.add_measurement_args(parser)
+    parser.add_argument('--checkpoint-every', help='Save results every this many seconds of runtime, instead of at 1,2,..,10,50,100,.. CPU days', type=float, default=None)
+    parser.add_argument('--total_time_budget', help='Total time (seconds) allowed', type=float, default=24.*60.*60.*2700.)  # 2700 CPU days;
+    args = vars(parser.parse_args())
+
+    address = (args['host'], args['port'])
+    if args['authkey'] is not None:
+        authkey = args['authkey'].encode()
+    elif args['role'] == 'coordinator' and args['host'] in ('localhost', '127.0.0.1'):
+        authkey = os.urandom(32)  # only the --local-workers started below need it
+    else:
+        # messages are unpickled, so anyone who can connect with the key can run code on the coordinator and workers
+        parser.error('--authkey is required for workers and for a coordinator that does not listen on localhost')
+
+    if args['role'] == 'worker':
+        print("running worker for coordinator at {}:{}".format(*address))
+        num_runs = run_worker(address, authkey, simulated_environment.make_environment(args), args['batch_size'])
+        print("worker done after {} runs".format(num_runs))
+        return
+
+    try: os.mkdir('results')
+    except OSError: pass
+
+    total_time_budget = args['total_time_budget']
+    stop_times = simulated_environment.make_stop_times(total_time_budget, args['checkpoint_every'])
+
+    num_configs = simulated_environment.make_environment(args).get_num_configs()
+    coordinator = Coordinator(num_configs, args['k0'], args['theta_multiplier'], stop_times, args['lease_timeout'])
+
+    workers = []
+    for _ in range(args['local_workers']):
+        worker = multiprocessing.Process(target=_local_worker, args=(address, authkey, args))
+        worker.start()
+        workers.append(worker)
+
+    print("running structured_procrastination_confidence coordinator on {}:{}".format(*address))
+    t0 = time.time()
+    best_config_index = coordinator.serve(address, authkey)
+    t1 = time.time()
+
+    for worker in workers:
+        worker.join()
+
+    print("")
+    print('best_config_index={}'.format(best_config_index))
+    print('total runtime: ' + format_runtime(coordinator.time_so_far))
+    print('total resumed runtime: ' + format_runtime(coordinator.total_resumed_runtime))
+    print("Total real time to run: {}".format(t1 - t0))
+
+
+if __name__ == '__main__':
+    main()
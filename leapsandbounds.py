@@ -16,10 +16,12 @@
 
 import argparse
 import os
+import sys
+import time
 import math
 import numpy as np
 import simulated_environment
-import pickle
+from async_writer import AsyncWriter, write_pickle
 from util import format_runtime
 
 R = 44  # Constant used for calculating b.
@@ -27,8 +29,8 @@ R2 = 32  # Constant used for the stopping condition (Appendix D, line 25).
 
 
 
-def leaps_and_bounds(env, n, epsilon, delta, zeta, k0, theta_multiplier):
-    """Implementation of LeapsAndBounds."""
+def leaps_and_bounds(env, n, epsilon, delta, zeta, k0, theta_multiplier, cache=None):
+    """Implementation of LeapsAndBounds. If a CappedRuntimeCache is given, RuntimeEst uses ebgstop_slave_alg_memo."""
     # This implementation makes some adjustments to the constants that control
     # how the failure probability budget zeta is allocated between the different
     # high-probability events that guarantee correctness.
@@ -40,7 +42,10 @@ def leaps_and_bounds(env, n, epsilon, delta, zeta, k0, theta_multiplier):
         print('b={}, theta={}, total runtime so far={}'.format(b, theta, env.get_total_runtime()))
         q_hat = []
         for i in range(n):
-            q_hat_i = ebgstop_slave_alg(env, i, b, delta, theta, k, epsilon, zeta, n)
+            if cache is None:
+                q_hat_i = ebgstop_slave_alg(env, i, b, delta, theta, k, epsilon, zeta, n)
+            else:
+                q_hat_i = ebgstop_slave_alg_memo(env, cache, i, b, delta, theta, k, epsilon, zeta, n)
             q_hat.append(q_hat_i)
         if np.min(q_hat) < theta:
             best_config_index = np.argmin(q_hat)
@@ -91,54 +96,246 @@ def ebgstop_slave_alg(env, i, b, delta, theta, k, epsilon, zeta, n):
     return np.mean(q)
 
 
+def ebgstop_schedule(length, delta, k, zeta, n):
+    """Returns the values of x and r2 used by ebgstop_slave_alg at steps j = 0, .., length - 1. They do not depend on
+    the runtimes, only on the step and the parameters. x is undefined (nan) at step 0, where it is not used.
+    """
+    beta = 1.10
+    xs = np.full(length, np.nan)
+    r2s = np.zeros(length)
+    kk = 0
+    x = np.nan
+    for j in range(length):
+        if j + 1 > np.floor(np.power(beta, kk)):
+            kk += 1
+            alpha = np.floor(np.power(beta, kk)) / np.floor(np.power(beta, kk - 1))
+            dk = (2.1 * k ** 1.5 * 2.61238 * (kk ** 1.1) * 10.5844 * n) / zeta
+            x = alpha * np.log(3 * dk)
+        xs[j] = x
+        if j > 0:
+            d_prime = zeta / (40 * 3 * n * k * (k + 1) * j * (j + 1))
+            r2s[j] = math.ceil(-R2 * np.log(d_prime) / delta)
+    return xs, r2s
+
+
+class CappedRuntimeCache(object):
+    """Memoizes what RuntimeEst computes from the runtimes, for reuse across LeapsAndBounds runs on one environment.
+
+    For each (config, runtime cap) this holds the capped runtimes of the config on its first instances, with their
+    running sums and sums of squares, extended on demand. The cap used at each theta is tau = 4 * theta / (3 * delta),
+    and every run follows the same sequence of thetas, so runs that share delta (and differ in epsilon) share these
+    prefixes. The step-dependent constants of RuntimeEst are memoized per (k, n, zeta, delta) as well.
+    """
+
+    def __init__(self, env, min_chunk=64):
+        """
+        Args:
+          env: the Environment whose measurements are read.
+          min_chunk: the number of instances read when a prefix is first needed.
+        """
+        self._env = env
+        self._instance_count = env.get_num_instances()
+        self.min_chunk = min_chunk
+        self._prefixes = {}  # (config, cap) -> (capped runtimes, running sums, running sums of squares)
+        self._schedules = {}  # (k, n, zeta, delta) -> (x, r2), see ebgstop_schedule
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self._prefixes = {}
+        self._schedules = {}
+
+    def get_prefix(self, config_id, tau, length):
+        """Returns the capped runtimes, running sums and running sums of squares of config <config_id> with cap <tau>,
+        for at least its first <length> instances.
+        """
+        key = (config_id, tau)
+        prefix = self._prefixes.get(key)
+        if prefix is not None and len(prefix[0]) >= length:
+            self.hits += 1
+            return prefix
+
+        self.misses += 1
+        start = 0 if prefix is None else len(prefix[0])
+        end = max(length, 2 * start)
+        row = self._env.get_config_results(config_id)
+        capped = np.minimum(np.fromiter((row[j % self._instance_count] for j in range(start, end)), dtype=np.float64, count=end - start), tau)
+        # Sums are accumulated sequentially, continuing from the previous prefix, as ebgstop_slave_alg does.
+        if prefix is None:
+            sums = np.cumsum(capped)
+            sums_squared = np.cumsum(capped * capped)
+            prefix = (capped, sums, sums_squared)
+        else:
+            sums = np.cumsum(np.concatenate(([prefix[1][-1]], capped)))[1:]
+            sums_squared = np.cumsum(np.concatenate(([prefix[2][-1]], capped * capped)))[1:]
+            prefix = (np.concatenate((prefix[0], capped)), np.concatenate((prefix[1], sums)), np.concatenate((prefix[2], sums_squared)))
+        self._prefixes[key] = prefix
+        return prefix
+
+    def get_schedule(self, length, delta, k, zeta, n):
+        """Returns x and r2 (see ebgstop_schedule) for at least the first <length> steps."""
+        key = (k, n, zeta, delta)
+        schedule = self._schedules.get(key)
+        if schedule is None or len(schedule[0]) < length:
+            schedule = ebgstop_schedule(max(length, 0 if schedule is None else 2 * len(schedule[0])), delta, k, zeta, n)
+            self._schedules[key] = schedule
+        return schedule
+
+
+def ebgstop_slave_alg_memo(env, cache, i, b, delta, theta, k, epsilon, zeta, n):
+    """Equivalent to ebgstop_slave_alg, evaluated a chunk of steps at a time over the runtimes memoized in <cache>.
+
+    Returns the same estimate, and makes exactly the same runs on <env>, as ebgstop_slave_alg, so the runtime
+    accounting of env is unchanged.
+    """
+    t = b * theta  # Corresponds to T in the paper.
+    tau = 4 * theta / (3 * delta)
+    timeouts = []  # runtime caps of the runs made so far, per chunk
+    start = 0
+    result = None
+
+    while result is None:
+        end = min(b, max(2 * start, cache.min_chunk))
+        capped, sumq, sum_q_squared = cache.get_prefix(i, tau, end)
+        x, r2 = cache.get_schedule(end, delta, k, zeta, n)
+
+        q = capped[start:end]
+        t_before = np.subtract.accumulate(np.concatenate(([t], q)))[:-1]  # remaining time before each step
+        timeouts.append(np.minimum(t_before, tau))
+
+        # The first step whose capped runtime reaches the remaining time uses it up, and RuntimeEst returns theta.
+        exhausted = np.nonzero(q >= t_before)[0]
+        stop = start + exhausted[0] if len(exhausted) else end
+
+        j = np.arange(start, stop)
+        with np.errstate(invalid='ignore'):
+            q_mean = sumq[start:stop] / (j + 1)
+            q_var = np.maximum((sum_q_squared[start:stop] - q_mean * sumq[start:stop]) / (j + 1), 0)
+            confidence = np.sqrt(q_var * 2 * x[start:stop] / (j + 1)) + 3 * tau * x[start:stop] / (j + 1)
+            lower_bound = q_mean - confidence
+            worse = (j > 0) & ((1 + 3 * epsilon / 7) * lower_bound > theta) & (q_mean > theta)
+            accurate = (j > 0) & (j + 1 >= r2[start:stop]) & (confidence <= (epsilon * q_mean) / (2 + 2 * epsilon))
+        stopped = np.nonzero(worse | accurate)[0]
 
-def main(epsilon, delta):
+        if len(stopped):
+            stop = start + stopped[0]
+            result = theta if worse[stopped[0]] else float(q_mean[stopped[0]])
+        elif len(exhausted):
+            result = theta
+        elif end == b:
+            stop = b - 1
+            result = np.mean(capped[:b])
+        else:
+            t = t_before[-1] - q[-1]
+            start = end
+            continue
+        timeouts[-1] = timeouts[-1][:stop - start + 1]
+
+    for j, timeout in enumerate(np.concatenate(timeouts).tolist()):
+        env.run(config_id=i, instance_id=j, timeout=timeout)
+    return result
+
+
+def leaps_and_bounds_sweep(env, n, epsilons, deltas, zeta, k0, theta_multiplier):
+    """Runs LeapsAndBounds for every (epsilon, delta) cell of a grid on one environment.
+
+    Cells are run delta by delta, sharing a CappedRuntimeCache, and the environment is reset before each cell, so
+    every cell's runtime accounting is the same as if it was run alone.
+
+    Returns:
+      A list with the outcome of each cell, epsilon by epsilon, in the format of results_lb_grid.p.
+    """
+    cache = CappedRuntimeCache(env)
+    outcomes = {}
+    for delta in deltas:
+        cache.clear()
+        for epsilon in epsilons:
+            print('----- epsilon={}, delta={} -----'.format(epsilon, delta))
+            env.reset()
+            best_config_index, capped_avg, tau = leaps_and_bounds(env, n, epsilon, delta, zeta, k0, theta_multiplier, cache)
+            print('best_config_index={}, capped_avg={}, tau={}'.format(best_config_index, capped_avg, tau))
+            outcomes[(epsilon, delta)] = {'best_config':best_config_index, 'epsilon':epsilon, 'delta':delta, 'total_runtime':env.get_total_runtime(), 'total_resumed_runtime':env.get_total_resumed_runtime()}
+    return [outcomes[(epsilon, delta)] for epsilon in epsilons for delta in deltas]
+
+
+
+def _parse_args():
     parser = argparse.ArgumentParser(description='Executes LeapsAndBounds with a simulated environment.')
     parser.add_argument('--zeta', help='Zeta from the paper', type=float, default=0.1)
     parser.add_argument('--k0', help='Kappa_0 from the paper', type=float, default=1.)
     parser.add_argument('--theta-multiplier', help='Theta multiplier from the paper', type=float, default=1.25)
-    parser.add_argument('--measurements-filename', help='Filename to load measurement results from', type=str, default='measurements.dump')
-    parser.add_argument('--measurements-timeout', help='Timeout (seconds) used for the measurements', type=float, default=900.)
-    args = vars(parser.parse_args())
+    simulated_environment.add_measurement_args(parser)
+    parser.add_argument('--sweep', help='Run the epsilon/delta grid on one environment, sharing RuntimeEst work between cells with the same delta', action='store_true')
+    return vars(parser.parse_args())
+
+
+def _make_env(args):
+    print("creating simulated environment")
+    return simulated_environment.make_environment(args)
+
+
+def main(epsilon, delta, writer=None):
+    args = _parse_args()
 
     zeta = args['zeta']
     k0 = args['k0']
     theta_multiplier = args['theta_multiplier']
-    results_file = args['measurements_filename']
-    timeout = args['measurements_timeout']
 
     try: os.mkdir('results')
     except OSError: pass
 
-    print("creating simulated environment")
-    env = simulated_environment.Environment(results_file, timeout)
+    env = _make_env(args)
     num_configs = env.get_num_configs()
 
     print("running leaps_and_bounds")
     best_config_index, capped_avg, tau = leaps_and_bounds(env, num_configs, epsilon, delta, zeta, k0, theta_multiplier)
     print('best_config_index={}, capped_avg={}, tau={}'.format(best_config_index, capped_avg, tau))
-    env.print_config_stats(best_config_index, tau=tau)
+    env.print_config_stats(best_config_index, tau=tau, writer=writer)
     print('total runtime: ' + format_runtime(env.get_total_runtime()))
     print('total resumed runtime: ' + format_runtime(env.get_total_resumed_runtime()))
 
     return best_config_index, env.get_total_runtime(), env.get_total_resumed_runtime()
 
 
+def main_sweep(epsilons, deltas):
+    args = _parse_args()
+
+    try: os.mkdir('results')
+    except OSError: pass
+
+    env = _make_env(args)
+
+    print("running leaps_and_bounds sweep")
+    t0 = time.time()
+    results = leaps_and_bounds_sweep(env, env.get_num_configs(), epsilons, deltas, args['zeta'], args['k0'], args['theta_multiplier'])
+    t1 = time.time()
+    print("Total real time to run: {}".format(t1 - t0))
+
+    write_pickle(os.path.join('results', 'results_lb_grid.p'), results)
+
+
 if __name__ == '__main__':
 
     epsilons = [.9, .85, .8, .75, .7, .65, .6, .55, .5, .45, .4, .35, .3, .25, .2, .15, .1]
     deltas = [.5, .45, .4, .35, .3, .25, .2, .15, .1]
 
+    if _parse_args()['sweep']:
+        main_sweep(epsilons, deltas)
+        sys.exit()
+
+    writer = AsyncWriter()
     results = []
-    for epsilon in epsilons:
-        for delta in deltas:
-            print('----- epsilon={}, delta={} -----'.format(epsilon, delta))
+    try:  # the writer's thread is a daemon, so wait for the queued results even if a run fails
+        for epsilon in epsilons:
+            for delta in deltas:
+                print('----- epsilon={}, delta={} -----'.format(epsilon, delta))
 
-            best_config_index, total_runtime, total_resumed_runtime = main(epsilon, delta)
+                best_config_index, total_runtime, total_resumed_runtime = main(epsilon, delta, writer)
 
-            results.append({'best_config':best_config_index, 'epsilon':epsilon, 'delta':delta, 'total_runtime':total_runtime, 'total_resumed_runtime':total_resumed_runtime})
+                results.append({'best_config':best_config_index, 'epsilon':epsilon, 'delta':delta, 'total_runtime':total_runtime, 'total_resumed_runtime':total_resumed_runtime})
 
 
-        with open(os.path.join('results', 'results_lb_grid.p'), 'wb') as f:
-            pickle.dump(results, f)
+            writer.submit(os.path.join('results', 'results_lb_grid.p'), results)
+    finally:
+        writer.close()
 
@@ -0,0 +1,226 @@
+#!/usr/bin/python
+#
+# Copyright 2019 D R Graham
+
+import argparse
+import collections
+import heapq
+import os
+import time
+import simulated_environment
+from async_writer import AsyncWriter, write_pickle
+from configuration_tester import ConfigurationTester, LcbRefreshScheduler, IncumbentTracker
+from util import format_runtime, day_in_seconds
+
+Completion = collections.namedtuple('Completion', ['tag', 'config_id', 'instance_id', 'timeout', 'did_timeout', 'runtime', 'resumed_runtime', 'core', 'start_time', 'finish_time'])
+
+
+class ParallelEnvironment(object):
+    """Discrete-event simulation of <num_cores> cores running tasks on top of a sequential Environment.
+
+    Tasks are submitted at the current simulated time and start on the first core to become free, in order of
+    submission. Runtimes still come from the wrapped environment, which is run as soon as a task is submitted, so
+    its total runtime and resumed runtime remain the CPU time used. Completions are returned in order of simulated
+    finish time, and each one advances the simulated wall clock to its finish time.
+    """
+
+    def __init__(self, env, num_cores, charge_resumed=False):
+        """
+        Args:
+          env: the Environment to read runtimes from.
+          num_cores: the number of simulated cores.
+          charge_resumed: if True, a task occupies its core only for its resumed
+            runtime, i.e. runs that continue an earlier capped run of the same
+            config and instance are resumed rather than restarted.
+        """
+        if num_cores < 1:
+            raise ValueError('num_cores must be at least 1. num_cores={}'.format(num_cores))
+        self._env = env
+        self._num_cores = num_cores
+        self._charge_resumed = charge_resumed
+        self.reset()
+
+    def reset(self):
+        """Reset the state of the simulation and of the wrapped environment."""
+        self._env.reset()
+        self._now = 0.
+        self._cores = [(0., core) for core in range(self._num_cores)]  # heap of (time the core becomes free, core)
+        self._completions = []  # heap of (finish time, submission number, Completion)
+        self._num_submitted = 0
+        self._busy_time = 0.
+
+    def get_env(self):
+        return self._env
+
+    def get_num_cores(self):
+        return self._num_cores
+
+    def get_num_configs(self):
+        return self._env.get_num_configs()
+
+    def get_num_instances(self):
+        return self._env.get_num_instances()
+
+    def get_total_runtime(self):
+        return self._env.get_total_runtime()
+
+    def get_total_resumed_runtime(self):
+        return self._env.get_total_resumed_runtime()
+
+    def get_wall_clock_time(self):
+        """Returns the current simulated time, i.e. the finish time of the last completion returned."""
+        return self._now
+
+    def get_busy_time(self):
+        """Returns the total core time occupied by the tasks submitted so far."""
+        return self._busy_time
+
+    def get_utilisation(self):
+        """Returns the fraction of core time up to the current simulated time spent running tasks."""
+        if self._now <= 0.:
+            return 0.
+        busy = self._busy_time - sum(c.finish_time - max(c.start_time, self._now) for _, _, c in self._completions if c.finish_time > self._now)
+        return min(1., busy / (self._num_cores * self._now))
+
+    def num_pending(self):
+        """Returns the number of tasks submitted but not yet returned by next_completion."""
+        return len(self._completions)
+
+    def num_idle_cores(self):
+        """Returns the number of cores that have no task to run at the current simulated time."""
+        return max(0, self._num_cores - len(self._completions))
+
+    def submit(self, config_id, timeout, instance_id=None, tag=None):
+        """Submits a run of config <config_id> on instance <instance_id> with runtime cap <timeout>.
+
+        Args:
+          tag: any value, returned with the run's Completion.
+
+        Returns:
+          The core the run is scheduled on.
+        """
+        did_timeout, runtime, resumed_runtime = self._env.run(config_id=config_id, timeout=timeout, instance_id=instance_id)
+        duration = resumed_runtime if self._charge_resumed else runtime
+        free_time, core = heapq.heappop(self._cores)
+        start_time = max(free_time, self._now)
+        finish_time = start_time + duration
+        heapq.heappush(self._cores, (finish_time, core))
+        self._busy_time += duration
+        completion = Completion(tag, config_id, instance_id, timeout, did_timeout, runtime, resumed_runtime, core, start_time, finish_time)
+        heapq.heappush(self._completions, (finish_time, self._num_submitted, completion))
+        self._num_submitted += 1
+        return core
+
+    def next_completion(self):
+        """Returns the pending run with the earliest finish time, advancing the simulated time to it.
+
+        Ties are returned in order of submission. Returns None if no runs are pending.
+        """
+        if not self._completions:
+            return None
+        finish_time, _, completion = heapq.heappop(self._completions)
+        self._now = max(self._now, finish_time)
+        return completion
+
+
+def parallel_spc(penv, n, k0, theta_multiplier, stop_times, writer=None):
+    """Runs Structured Procrastination with Confidence on the cores of a ParallelEnvironment.
+
+    Whenever a core is idle, the config with the smallest lcb that has no run in flight is given its next task, as
+    in distributed_spc. Results are logged when the total CPU time reaches each stop time, with the simulated wall
+    clock time and core utilisation alongside the usual fields. If writer is set, results are saved in the background
+    by that AsyncWriter.
+
+    Returns:
+      The index of the best config and the list of logged results.
+    """
+    penv.reset()
+    configs = dict((i, ConfigurationTester(i, k0, theta_multiplier)) for i in range(n))
+    scheduler = LcbRefreshScheduler(configs)
+    tracker = IncumbentTracker(n)
+    runtime_per_config = [0.] * n
+    busy = set()
+
+    iter_count = 0
+    time_so_far = 0.
+    stage = 0
+    results = []
+    dump = writer.submit if writer is not None else write_pickle
+
+    while stage < len(stop_times):
+        while penv.num_idle_cores() > 0:
+            task = scheduler.next_free_task(iter_count, busy)
+            if task is None:
+                break
+            cid, l, theta = task
+            penv.submit(cid, theta, instance_id=l)
+
+        c = penv.next_completion()
+        config = configs[c.config_id]
+        _, rt, _, _ = config.record_result(c.instance_id, c.timeout, c.did_timeout, c.runtime, iter_count)
+        busy.discard(c.config_id)
+        time_so_far += rt
+        runtime_per_config[c.config_id] += c.resumed_runtime
+        tracker.update(c.config_id, config.r, runtime_per_config[c.config_id])
+        iter_count += 1
+
+        while stage < len(stop_times) and time_so_far >= stop_times[stage]:
+            i_star, i_star_r = tracker.get_incumbent()
+            print("------- cpu_days_so_far={}, wall_clock_days={}, utilisation={:.3f}, iter_count={}, best_config_id={}, best_config_r={}, saving results -------".format(int(time_so_far / day_in_seconds), penv.get_wall_clock_time() / day_in_seconds, penv.get_utilisation(), iter_count, i_star, i_star_r))
+            results.append({'iterations':iter_count,
+                            'best_config':i_star,
+                            'best_config_theta':configs[i_star].theta,
+                            'best_config_r':i_star_r,
+                            'best_config_q':configs[i_star].q,
+                            'total_runtime':time_so_far,
+                            'total_resumed_runtime':penv.get_total_resumed_runtime(),
+                            'wall_clock_time':penv.get_wall_clock_time(),
+                            'utilisation':penv.get_utilisation(),
+                            'num_cores':penv.get_num_cores()})
+            dump(os.path.join('results', 'results_spc_parallel.p'), results)  # periodically save results
+            stage += 1
+
+    i_star, _ = tracker.get_incumbent()
+    return i_star, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Executes Structured Procrastination with Confidence on a simulated machine with several cores.')
+    parser.add_argument('--num-cores', help='Number of simulated cores', type=int, default=8)
+    parser.add_argument('--charge-resumed', help='Occupy a core only for the resumed part of each run', action='store_true')
+    parser.add_argument('--k0', help='Kappa_0 from the paper', type=float, default=1.)
+    parser.add_argument('--theta-multiplier', help='Theta multiplier from the paper', type=float, default=2.)
+    simulated_environment.add_measurement_args(parser)
+    parser.add_argument('--total_time_budget', help='Total CPU time (seconds) allowed', type=float, default=24.*60.*60.*2700.)  # 2700 CPU days;
+    args = vars(parser.parse_args())
+
+    try: os.mkdir('results')
+    except OSError: pass
+
+    total_time_budget = args['total_time_budget']
+    stop_times = simulated_environment.make_stop_times(total_time_budget)
+
+    print("creating simulated environment")
+    env = simulated_environment.make_environment(args)
+    penv = ParallelEnvironment(env, args['num_cores'], args['charge_resumed'])
+
+    print("running structured_procrastination_confidence on {} simulated cores".format(args['num_cores']))
+    writer = AsyncWriter()
+    try:  # the writer's thread is a daemon, so wait for the queued results even if the run fails
+        t0 = time.time()
+        best_config_index, _ = parallel_spc(penv, env.get_num_configs(), args['k0'], args['theta_multiplier'], stop_times, writer)
+        t1 = time.time()
+    finally:
+        writer.close()
+
+    print("")
+    print('best_config_index={}'.format(best_config_index))
+    print('total runtime: ' + format_runtime(penv.get_total_runtime()))
+    print('total resumed runtime: ' + format_runtime(penv.get_total_resumed_runtime()))
+    print('wall clock time: ' + format_runtime(penv.get_wall_clock_time()))
+    print('core utilisation: {}'.format(penv.get_utilisation()))
+    print("Total real time to run: {}".format(t1 - t0))
+
+
+if __name__ == '__main__':
+    main()
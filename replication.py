@@ -0,0 +1,332 @@
+#!/usr/bin/python
+#
+# Copyright 2019 D R Graham
+
+import argparse
+import math
+import os
+import pickle
+import time
+import numpy as np
+from simulated_environment import instance_permutation, make_stop_times
+from tester_bank import TesterBank
+from async_writer import write_pickle
+from configuration_tester import compute_confidence_bounds
+from leapsandbounds import R, ebgstop_schedule
+from util import format_runtime
+
+
+class MultiSeedEnvironment(object):
+    """Simulates runs for several replicates at once, each with its own random instance order.
+
+    The measurement matrix is loaded once and shared by all replicates. Replicate s
+    sees the instances in the order given by instance_permutation(seeds[s]), the
+    same order as simulated_environment.Environment(..., shuffle_seed=seeds[s]),
+    and has its own runtime accounting.
+    """
+
+    def __init__(self, results_file, timeout, seeds):
+        """
+        Args:
+          results_file: the location of the pickle dump containing the results
+            of the runtime measurements.
+          timeout: the timeout used for the runtime measurements.
+          seeds: one shuffle seed per replicate.
+        """
+        self._timeout = timeout
+
+        with open(results_file, 'rb') as f:
+            results = pickle.load(f)
+
+        self._results = np.array([results[k] for k in sorted(results.keys())], dtype=np.float64)
+        self._instance_count = self._results.shape[1]
+        self._seeds = list(seeds)
+        self._perms = np.array([instance_permutation(seed, self._instance_count) for seed in self._seeds])
+        self.reset()
+
+    def reset(self):
+        """Reset the state of the environment for all replicates."""
+        num_seeds = len(self._seeds)
+        self._total_runtime = np.zeros(num_seeds)
+        self._total_resumed_runtime = np.zeros(num_seeds)
+        self._runtime_per_config = np.zeros((num_seeds, self._results.shape[0]))
+        # Dict mapping (replicate, configuration, instance) to how long it ran so far in total, with resuming.
+        self._ran_so_far = {}
+
+    def get_seeds(self):
+        return self._seeds
+
+    def get_num_configs(self):
+        return self._results.shape[0]
+
+    def get_num_instances(self):
+        return self._instance_count
+
+    def run_batch(self, replicates, config_ids, timeouts, instance_ids):
+        """Simulates one run for each of several replicates.
+
+        Args:
+          replicates: array of replicate indices, each appearing at most once.
+          config_ids: array of configurations to run, one per replicate.
+          timeouts: array of timeouts to simulate the runs with.
+          instance_ids: array of instances to run, in each replicate's own order.
+
+        Raises:
+          ValueError: if any timeout is larger than the measurements' timeout.
+
+        Returns:
+          A tuple of arrays of whether each run timed out, how long it ran, and
+          how long it ran with resuming.
+        """
+        if np.any(timeouts > self._timeout):
+            raise ValueError('timeout provided is too high to be simulated. timeout={}'.format(np.max(timeouts)))
+        instances = self._perms[replicates, instance_ids % self._instance_count]
+        measured = self._results[config_ids, instances]
+        runtimes = np.minimum(timeouts, measured)
+        keys = list(zip(replicates.tolist(), config_ids.tolist(), instance_ids.tolist()))
+        ran_so_far = self._ran_so_far
+        resumed_runtimes = runtimes - np.array([ran_so_far.get(key, 0.) for key in keys])
+        ran_so_far.update(zip(keys, runtimes.tolist()))
+        self._total_runtime[replicates] += runtimes
+        self._total_resumed_runtime[replicates] += resumed_runtimes
+        self._runtime_per_config[replicates, config_ids] += resumed_runtimes
+        return timeouts <= measured, runtimes, resumed_runtimes
+
+    def view(self, replicate):
+        """Returns an Environment-like view of a single replicate."""
+        return _ReplicateView(self, replicate)
+
+
+class _ReplicateView(object):
+    """Environment interface onto one replicate of a MultiSeedEnvironment."""
+
+    def __init__(self, env, replicate):
+        self._env = env
+        self._replicate = replicate
+        self._replicates = np.array([replicate])
+
+    def get_num_configs(self):
+        return self._env.get_num_configs()
+
+    def get_num_instances(self):
+        return self._env.get_num_instances()
+
+    def get_total_runtime(self):
+        return self._env._total_runtime[self._replicate]
+
+    def get_total_resumed_runtime(self):
+        return self._env._total_resumed_runtime[self._replicate]
+
+    def get_runtime_per_config(self):
+        return self._env._runtime_per_config[self._replicate]
+
+    def run(self, config_id, timeout, instance_id=None):
+        if instance_id is None:
+            instance_id = np.random.randint(self._env.get_num_instances())
+        did_timeout, runtime, resumed_runtime = self._env.run_batch(self._replicates, np.array([config_id]), np.array([timeout], dtype=np.float64), np.array([instance_id]))
+        return bool(did_timeout[0]), float(runtime[0]), float(resumed_runtime[0])
+
+
+def replicate_spc(env, n, k0, theta_multiplier, stop_times):
+    """Runs Structured Procrastination with Confidence for every replicate of a MultiSeedEnvironment in lockstep.
+
+    Each replicate keeps its config state in a TesterBank. Each round, every replicate that has not reached its last
+    stop time selects a config and its next task exactly as structured_procrastination_confidence does, and the runs
+    for all replicates are simulated in one batch.
+
+    Returns:
+      A dict mapping each seed to its anytime curve: the list of result dicts logged at each stop time, in the
+      format of results_spc.p.
+    """
+    env.reset()
+    seeds = env.get_seeds()
+    num_seeds = len(seeds)
+    banks = [TesterBank(n, k0, theta_multiplier) for _ in range(num_seeds)]
+
+    time_so_far = np.zeros(num_seeds)
+    iter_count = 0  # replicates step in lockstep, so they share the iteration count
+    stage = np.zeros(num_seeds, dtype=np.int64)  # index of the next stop time for each replicate
+    curves = dict((seed, []) for seed in seeds)
+
+    def checkpoint(s):
+        while stage[s] < len(stop_times) and time_so_far[s] >= stop_times[stage[s]]:
+            bank = banks[s]
+            i_star = bank.get_incumbent()
+            curves[seeds[s]].append({'iterations':iter_count,
+                                     'best_config':i_star,
+                                     'best_config_theta':float(bank.theta[i_star]),
+                                     'best_config_r':bank.get_num_active(i_star),
+                                     'best_config_q':float(bank.q[i_star]),
+                                     'total_runtime':float(time_so_far[s]),
+                                     'total_resumed_runtime':float(env._total_resumed_runtime[s])})
+            stage[s] += 1
+
+    for s in range(num_seeds):
+        checkpoint(s)
+
+    while True:
+        active = np.nonzero(stage < len(stop_times))[0]
+        if len(active) == 0:
+            break
+
+        config_ids = np.empty(len(active), dtype=np.int64)
+        instance_ids = np.empty(len(active), dtype=np.int64)
+        timeouts = np.empty(len(active))
+        for b, s in enumerate(active):
+            i = banks[s].argmin_confidence_bound(iter_count)
+            config_ids[b] = i
+            instance_ids[b], timeouts[b] = banks[s].next_task(i)
+
+        did_timeout, elapsed, _ = env.run_batch(active, config_ids, timeouts, instance_ids)
+
+        for b, s in enumerate(active):
+            _, elapsed_time, _, _ = banks[s].record_result(int(config_ids[b]), int(instance_ids[b]), float(timeouts[b]), bool(did_timeout[b]), float(elapsed[b]), iter_count, update_lcb=False)
+            time_so_far[s] += elapsed_time
+
+        # Re-compute the lcbs of the configs just executed, for all replicates at once.
+        lcbs = compute_confidence_bounds([banks[s].runtimes[i] for s, i in zip(active, config_ids)], [int(banks[s].r[i]) for s, i in zip(active, config_ids)], iter_count)
+        for b, s in enumerate(active):
+            banks[s].lcb[config_ids[b]] = lcbs[b]
+            banks[s].t_last_update_lcb[config_ids[b]] = iter_count
+
+        iter_count += 1
+        for s in active:
+            checkpoint(s)
+
+    return curves
+
+
+def _runtime_est_batch(env, replicates, i, b, delta, theta, k, epsilon, zeta, n, schedule):
+    """RuntimeEst (ebgstop_slave_alg) of config <i> for several replicates of a MultiSeedEnvironment at once.
+
+    Each step runs config i on instance j for every replicate whose estimate is not settled yet, in one batch. Gives
+    the same estimates, from the same runs, as ebgstop_slave_alg on each replicate in turn.
+
+    Args:
+      replicates: array of the replicates to estimate for.
+      schedule: x and r2 for the first b steps (see ebgstop_schedule).
+
+    Returns:
+      An array with the estimate for each replicate.
+    """
+    xs, r2s = schedule
+    m = len(replicates)
+    tau = 4 * theta / (3 * delta)
+    t = np.full(m, b * theta)  # Corresponds to T in the paper.
+    q = np.empty((m, b))
+    sumq = np.zeros(m)
+    sum_q_squared = np.zeros(m)
+    estimates = np.full(m, np.nan)
+    live = np.arange(m)  # replicates whose estimate is not settled yet
+    for j in range(b):
+        if len(live) == 0:
+            break
+        _, elapsed, _ = env.run_batch(replicates[live], np.full(len(live), i, dtype=np.int64), np.minimum(t[live], tau), np.full(len(live), j, dtype=np.int64))
+        t[live] -= elapsed
+        q[live, j] = elapsed
+        sumq[live] += elapsed
+        sum_q_squared[live] += elapsed * elapsed
+        exhausted = t[live] == 0
+        estimates[live[exhausted]] = theta
+        live = live[~exhausted]
+
+        if j > 0 and len(live):
+            q_mean = sumq[live] / (j + 1)
+            q_var = np.maximum((sum_q_squared[live] - q_mean * sumq[live]) / (j + 1), 0)
+            confidence = np.sqrt(q_var * 2 * xs[j] / (j + 1)) + 3 * tau * xs[j] / (j + 1)
+            lower_bound = q_mean - confidence
+            worse = ((1 + 3 * epsilon / 7) * lower_bound > theta) & (q_mean > theta)
+            accurate = ~worse & (j + 1 >= r2s[j]) & (confidence <= (epsilon * q_mean) / (2 + 2 * epsilon))
+            estimates[live[worse]] = theta
+            estimates[live[accurate]] = q_mean[accurate]
+            live = live[~(worse | accurate)]
+    for s in live:
+        estimates[s] = np.mean(q[s])
+    return estimates
+
+
+def replicate_lb(env, n, epsilon, delta, zeta, k0, theta_multiplier):
+    """Runs LeapsAndBounds for every replicate of a MultiSeedEnvironment in lockstep.
+
+    Every replicate follows the same sequence of thetas and sample sizes b, so the replicates that have not returned
+    yet estimate each config together, with the runs of each RuntimeEst step simulated in one batch. Makes the same
+    runs, and returns the same outcomes, as leaps_and_bounds on each replicate in turn.
+
+    Returns:
+      A dict mapping each seed to a dict with the best config and the runtimes used.
+    """
+    env.reset()
+    seeds = env.get_seeds()
+    active = np.arange(len(seeds))  # replicates still running
+    outcomes = {}
+    theta = k0 * 16. / 7
+    k = 0
+    while len(active):
+        k += 1
+        b = int(math.ceil(R * math.log(40 * 3 * n * k * (k + 1) / zeta) / (delta * epsilon * epsilon)))
+        print('b={}, theta={}, replicates running={}'.format(b, theta, len(active)))
+        schedule = ebgstop_schedule(b, delta, k, zeta, n)
+        q_hat = np.array([_runtime_est_batch(env, active, i, b, delta, theta, k, epsilon, zeta, n, schedule) for i in range(n)]).T
+        done = np.min(q_hat, axis=1) < theta
+        for row in np.nonzero(done)[0]:
+            s = active[row]
+            best_config_index = np.argmin(q_hat[row])
+            outcomes[seeds[s]] = {'best_config':int(best_config_index),
+                                  'capped_avg':float(q_hat[row, best_config_index]),
+                                  'tau':4 * theta / (3 * delta),
+                                  'total_runtime':float(env._total_runtime[s]),
+                                  'total_resumed_runtime':float(env._total_resumed_runtime[s])}
+        active = active[~done]
+        theta *= theta_multiplier
+    return outcomes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replicates a configuration procedure over many random instance orderings.')
+    parser.add_argument('--procedure', help='Configuration procedure to replicate', choices=['spc', 'lb'], default='spc')
+    parser.add_argument('--num-seeds', help='Number of replicates', type=int, default=10)
+    parser.add_argument('--first-seed', help='Shuffle seed of the first replicate', type=int, default=0)
+    parser.add_argument('--k0', help='Kappa_0 from the paper', type=float, default=1.)
+    parser.add_argument('--theta-multiplier', help='Theta multiplier from the paper (default: 2.0 for spc, 1.25 for lb)', type=float, default=None)
+    parser.add_argument('--epsilon', help='Epsilon from the paper (lb only)', type=float, default=0.1)
+    parser.add_argument('--delta', help='Delta from the paper (lb only)', type=float, default=0.2)
+    parser.add_argument('--zeta', help='Zeta from the paper (lb only)', type=float, default=0.1)
+    parser.add_argument('--measurements-filename', help='Filename to load measurement results from', type=str, default='measurements.dump')
+    parser.add_argument('--measurements-timeout', help='Timeout (seconds) used for the measurements', type=float, default=900.)
+    parser.add_argument('--total-time-budget', help='Total time (seconds) allowed per replicate (spc only)', type=float, default=24.*60.*60.*100.)
+    args = vars(parser.parse_args())
+
+    try: os.mkdir('results')
+    except OSError: pass
+
+    seeds = list(range(args['first_seed'], args['first_seed'] + args['num_seeds']))
+
+    print("creating simulated environment")
+    env = MultiSeedEnvironment(args['measurements_filename'], args['measurements_timeout'], seeds)
+    num_configs = env.get_num_configs()
+
+    t0 = time.time()
+    if args['procedure'] == 'spc':
+        theta_multiplier = args['theta_multiplier'] if args['theta_multiplier'] is not None else 2.
+        stop_times = make_stop_times(args['total_time_budget'])
+
+        print("running structured_procrastination_confidence for {} seeds".format(len(seeds)))
+        results = replicate_spc(env, num_configs, args['k0'], theta_multiplier, stop_times)
+        for seed in seeds:
+            print('seed={}, best_config_index={}'.format(seed, results[seed][-1]['best_config']))
+    else:
+        theta_multiplier = args['theta_multiplier'] if args['theta_multiplier'] is not None else 1.25
+
+        print("running leaps_and_bounds for {} seeds".format(len(seeds)))
+        results = replicate_lb(env, num_configs, args['epsilon'], args['delta'], args['zeta'], args['k0'], theta_multiplier)
+        for seed in seeds:
+            print('seed={}, best_config_index={}, total runtime: {}'.format(seed, results[seed]['best_config'], format_runtime(results[seed]['total_runtime'])))
+    t1 = time.time()
+
+    write_pickle(os.path.join('results', 'results_{}_seeds.p'.format(args['procedure'])), results)
+
+    print("Total real time to run: {}".format(t1 - t0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+#!/usr/bin/python
+#
+# Copyright 2019 D R Graham
+
+import argparse
+import time
+import numpy as np
+from util import format_runtime
+
+# A trace file is TRACE_MAGIC, one HEADER_DTYPE record, then one TRACE_DTYPE record per call to Environment.run.
+# The header also holds the options of structured_procrastination_confidence that change its decisions, so that a
+# replay makes the same ones; options that were not set are stored as -1.
+TRACE_MAGIC = b'SPCTRAC2'
+HEADER_DTYPE = np.dtype([('num_configs', '<u4'),
+                         ('num_instances', '<u4'),
+                         ('timeout', '<f8'),
+                         ('adaptive_lcb', 'u1'),
+                         ('prune_every', '<i8'),
+                         ('stream_configs', '<i8'),
+                         ('stream_first_doubling', '<f8'),
+                         ('stream_seed', '<i8')])
+TRACE_OPTIONS = ['adaptive_lcb', 'prune_every', 'stream_configs', 'stream_first_doubling', 'stream_seed']
+TRACE_DTYPE = np.dtype([('config_id', '<u4'),
+                        ('instance_id', '<u4'),
+                        ('timeout', '<f8'),
+                        ('did_timeout', 'u1'),
+                        ('runtime', '<f8'),
+                        ('resumed_runtime', '<f8')])
+
+
+def read_trace(path):
+    """Reads a trace file written by TraceRecorder.
+
+    Returns:
+      The header (a HEADER_DTYPE record) and an array of TRACE_DTYPE records.
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(len(TRACE_MAGIC))
+        if magic == b'SPCTRACE':
+            raise ValueError('{} was recorded in an older trace format without the procedure options; record it again'.format(path))
+        if magic != TRACE_MAGIC:
+            raise ValueError('not a run trace: {}'.format(path))
+        header = np.fromfile(f, dtype=HEADER_DTYPE, count=1)[0]
+        records = np.fromfile(f, dtype=TRACE_DTYPE)
+    return header, records
+
+
+def trace_options(header):
+    """Returns the procedure options stored in a trace header, as a dict keyed by TRACE_OPTIONS with None for unset ones."""
+    options = {'adaptive_lcb': bool(header['adaptive_lcb'])}
+    for name in ['prune_every', 'stream_configs', 'stream_seed']:
+        options[name] = int(header[name]) if header[name] >= 0 else None
+    options['stream_first_doubling'] = float(header['stream_first_doubling']) if header['stream_first_doubling'] >= 0 else None
+    return options
+
+
+class _NullWriter(object):
+    """Stands in for an AsyncWriter and drops every write, so a replay leaves the recorded run's results alone."""
+
+    def submit(self, path, obj):
+        pass
+
+    def close(self):
+        pass
+
+
+class TraceRecorder(object):
+    """Wraps an Environment and records every call to run() into a binary trace file.
+
+    Records are buffered in a preallocated array and written to the file a block at a time. Every other method is
+    forwarded to the wrapped environment, so a TraceRecorder can be passed to the configuration procedures in place of
+    the environment. Call close() once done to write the last block.
+    """
+
+    def __init__(self, env, path, timeout, block_size=65536, options=None):
+        """
+        Args:
+          env: the Environment to record.
+          path: the trace file to write.
+          timeout: the timeout used for the runtime measurements.
+          block_size: the number of records buffered before they are written.
+          options: dict of the procedure options in TRACE_OPTIONS to store in the header; missing or None ones are
+            stored as unset.
+        """
+        self._env = env
+        self._buffer = np.zeros(block_size, dtype=TRACE_DTYPE)
+        self._buffered = 0
+        self.num_records = 0
+
+        options = options or {}
+        values = [options.get(name) for name in TRACE_OPTIONS]
+        header = np.array([(env.get_num_configs(), env.get_num_instances(), timeout) + tuple(-1 if v is None else v for v in values)], dtype=HEADER_DTYPE)
+        self._file = open(path, 'wb')
+        self._file.write(TRACE_MAGIC)
+        header.tofile(self._file)
+
+    def __getattr__(self, name):
+        return getattr(self._env, name)
+
+    def run(self, config_id, timeout, instance_id=None):
+        if instance_id is None:
+            instance_id = np.random.randint(self._env.get_num_instances())  # drawn here, as the environment would, so it can be recorded
+        did_timeout, runtime, resumed_runtime = self._env.run(config_id=config_id, timeout=timeout, instance_id=instance_id)
+
+        self._buffer[self._buffered] = (config_id, instance_id, timeout, did_timeout, runtime, resumed_runtime)
+        self._buffered += 1
+        self.num_records += 1
+        if self._buffered == len(self._buffer):
+            self.flush()
+        return did_timeout, runtime, resumed_runtime
+
+    def flush(self):
+        self._buffer[:self._buffered].tofile(self._file)
+        self._buffered = 0
+        self._file.flush()
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+
+class TraceReplayEnvironment(object):
+    """Environment that replays a trace written by TraceRecorder, with no measurement matrix.
+
+    Each call to run() returns the outcome of the next recorded run. A procedure that makes exactly the same calls as
+    the recorded one therefore reproduces its decisions; at the first call that differs from the trace, run() raises
+    a ValueError.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+          path: the trace file to replay.
+        """
+        header, records = read_trace(path)
+        self._num_configs = int(header['num_configs'])
+        self._instance_count = int(header['num_instances'])
+        self._timeout = float(header['timeout'])
+        self._options = trace_options(header)
+        self._config_ids = records['config_id'].tolist()
+        self._instance_ids = records['instance_id'].tolist()
+        self._timeouts = records['timeout'].tolist()
+        self._did_timeouts = records['did_timeout'].astype(bool).tolist()
+        self._runtimes = records['runtime'].tolist()
+        self._resumed_runtimes = records['resumed_runtime'].tolist()
+        self.reset()
+
+    def reset(self):
+        """Rewind to the start of the trace."""
+        self._position = 0
+        self._total_runtime = 0.
+        self._total_resumed_runtime = 0.
+        self._runtime_per_config = np.zeros(self._num_configs)
+
+    def get_num_configs(self):
+        return self._num_configs
+
+    def get_num_instances(self):
+        return self._instance_count
+
+    def get_options(self):
+        """Returns the procedure options the trace was recorded with (see trace_options)."""
+        return self._options
+
+    def get_num_runs(self):
+        return len(self._config_ids)
+
+    def get_position(self):
+        return self._position
+
+    def get_total_runtime(self):
+        return self._total_runtime
+
+    def get_total_resumed_runtime(self):
+        return self._total_resumed_runtime
+
+    def get_runtime_per_config(self):
+        return self._runtime_per_config
+
+    def run(self, config_id, timeout, instance_id=None):
+        """Returns the outcome of the next recorded run, as Environment.run does.
+
+        Raises:
+          ValueError: if the trace is exhausted, or if the config, instance or
+            timeout differ from the next recorded run.
+        """
+        k = self._position
+        if k >= len(self._config_ids):
+            raise ValueError('trace exhausted after {} runs'.format(k))
+        if instance_id is None:
+            instance_id = self._instance_ids[k]
+        if (config_id, instance_id, timeout) != (self._config_ids[k], self._instance_ids[k], self._timeouts[k]):
+            raise ValueError('run {} diverged from the trace: got config_id={}, instance_id={}, timeout={}; recorded config_id={}, instance_id={}, timeout={}'.format(
+                k, config_id, instance_id, timeout, self._config_ids[k], self._instance_ids[k], self._timeouts[k]))
+        self._position += 1
+
+        runtime = self._runtimes[k]
+        resumed_runtime = self._resumed_runtimes[k]
+        self._total_runtime += runtime
+        self._runtime_per_config[config_id] += resumed_runtime
+        self._total_resumed_runtime += resumed_runtime
+        return self._did_timeouts[k], runtime, resumed_runtime
+
+
+def diff_traces(path_a, path_b):
+    """Compares the decisions recorded in two traces: the config, instance and timeout of each run, and its outcome.
+
+    Returns:
+      None if the traces record the same runs, otherwise the index of the first run that differs (or the length of
+      the shorter trace, if one is a prefix of the other).
+    """
+    _, a = read_trace(path_a)
+    _, b = read_trace(path_b)
+    k = min(len(a), len(b))
+    fields = ['config_id', 'instance_id', 'timeout', 'did_timeout']
+    differs = np.zeros(k, dtype=bool)
+    for field in fields:
+        differs |= a[field][:k] != b[field][:k]
+    mismatches = np.nonzero(differs)[0]
+    if len(mismatches):
+        return int(mismatches[0])
+    if len(a) != len(b):
+        return k
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares run traces, or replays one through Structured Procrastination with Confidence to time the procedure alone.')
+    parser.add_argument('--diff', help='Two trace files to compare', type=str, nargs=2, default=None)
+    parser.add_argument('--replay', help='Trace file recorded from structured_procrastination_confidence.py to replay', type=str, default=None)
+    parser.add_argument('--k0', help='Kappa_0 from the paper', type=float, default=1.)
+    parser.add_argument('--theta-multiplier', help='Theta multiplier from the paper', type=float, default=2.)
+    args = vars(parser.parse_args())
+
+    if args['diff'] is not None:
+        path_a, path_b = args['diff']
+        k = diff_traces(path_a, path_b)
+        if k is None:
+            print('traces match')
+        else:
+            print('traces differ from run {}'.format(k))
+
+    if args['replay'] is not None:
+        from structured_procrastination_confidence import structured_procrastination_confidence, random_config_stream, DoublingAdmission
+        env = TraceReplayEnvironment(args['replay'])
+        options = env.get_options()
+        config_stream, admission = None, None
+        if options['stream_configs'] is not None:
+            config_stream = random_config_stream(env.get_num_configs(), options['stream_seed'])
+            admission = DoublingAdmission(options['stream_configs'], options['stream_first_doubling'])
+        time_budget = 0.
+        for runtime in env._runtimes:  # the runtime the procedure has counted after the last recorded run
+            time_budget += np.round(runtime, decimals=3)
+        stop_times = [time_budget]
+        t0 = time.time()
+        try:
+            best_config_index, _ = structured_procrastination_confidence(env, env.get_num_configs(), args['k0'], args['theta_multiplier'], stop_times[-1], stop_times,
+                                                                         options['adaptive_lcb'], options['prune_every'], config_stream, admission, writer=_NullWriter())
+            print('best_config_index={}'.format(best_config_index))
+        except ValueError as e:
+            print(e)
+        t1 = time.time()
+        print('replayed {} of {} runs'.format(env.get_position(), env.get_num_runs()))
+        print('total runtime: ' + format_runtime(env.get_total_runtime()))
+        print("Total real time to run: {}".format(t1 - t0))
+
+
+if __name__ == '__main__':
+    main()
@@ -18,18 +18,34 @@
 import collections
 import pickle
 import numpy as np
+from util import to_millis, from_millis, TIMEOUT_SENTINEL, day_in_seconds
+from async_writer import write_pickle
+
+
+def instance_permutation(seed, n_instances):
+    """Returns the instance order used for a given shuffle seed."""
+    return np.random.RandomState(seed).permutation(n_instances)
 
 
 class Environment(object):
     """This class is used for simulating runs and collecting statistics."""
 
-    def __init__(self, results_file, timeout):
+    _quantized = False  # whether self._results holds integer milliseconds (see util.to_millis)
+
+    def __init__(self, results_file, timeout, shuffle_seed=None, quantize=False):
         """Prepares an instance that can simulate runs based on a measurements file.
 
         Args:
           results_file: the location of the pickle dump containing the results
             of the runtime measurements.
           timeout: the timeout used for the runtime measurements.
+          shuffle_seed: if given, the instance order (for all configs) is
+            randomly permuted using this seed.
+          quantize: if True, the measurements are held as a uint32 matrix of
+            milliseconds, with runtimes above the timeout encoded as
+            util.TIMEOUT_SENTINEL, and simulated runtimes are rounded down to
+            milliseconds. Runs with caps of whole milliseconds time out as
+            they would without quantizing.
         """
         self._timeout = timeout
 
@@ -37,13 +53,16 @@ class Environment(object):
         with open(results_file, 'rb') as f:
             results = pickle.load(f)
 
-        # random.seed(1234) # random shuffle of instance order (for all configs)
-        # n_instances = len(results.values()[0])
-        # shuffle_mask = range(n_instances)
-        # random.shuffle(shuffle_mask)
-        # self._results = [list(np.array(results[k])[shuffle_mask]) for k in sorted(results.keys())]
+        self._config_keys = sorted(results.keys())
+        self._results = [results[k] for k in self._config_keys]
+
+        if shuffle_seed is not None:  # random shuffle of instance order (for all configs)
+            shuffle_mask = instance_permutation(shuffle_seed, len(self._results[0]))
+            self._results = [list(np.array(row)[shuffle_mask]) for row in self._results]
 
-        self._results = [results[k] for k in sorted(results.keys())]
+        if quantize:
+            self._results = to_millis(self._results, timeout)
+            self._quantized = True
 
         self._instance_count = len(self._results[0])
         self.reset()
@@ -66,6 +85,37 @@ class Environment(object):
         # configuration will be equal to the relevant value in `runtime_per_config`.
         self._ran_so_far = collections.defaultdict(lambda: collections.defaultdict(float))
 
+    def get_state(self):
+        """Returns the runtime accounting of the environment, as plain dicts that can be pickled."""
+        return {'total_runtime':self._total_runtime,
+                'total_resumed_runtime':self._total_resumed_runtime,
+                'runtime_per_config':dict(self._runtime_per_config),
+                'ran_so_far':dict((config_id, dict(ran)) for config_id, ran in self._ran_so_far.items())}
+
+    def set_state(self, state):
+        """Restores the runtime accounting returned by get_state."""
+        self.reset()
+        self._total_runtime = state['total_runtime']
+        self._total_resumed_runtime = state['total_resumed_runtime']
+        self._runtime_per_config.update(state['runtime_per_config'])
+        for config_id, ran in state['ran_so_far'].items():
+            self._ran_so_far[config_id].update(ran)
+
+    def reorder_instances(self, order):
+        """Reorders the instances (for all configs), so that instance j is the instance previously at order[j].
+
+        Should be called before any runs, since the runtime accounting refers to instances by position.
+        """
+        if self._quantized:
+            self._results = self._results[:, order]
+        else:
+            self._results = [list(np.array(row)[order]) for row in self._results]
+        self._instance_count = len(order)
+
+    def get_config_keys(self):
+        """Returns the keys of the configs in the measurements file, indexed by config id."""
+        return self._config_keys
+
     def get_num_configs(self):
         return len(self._results)
 
@@ -79,8 +129,15 @@ class Environment(object):
         return self._total_resumed_runtime
 
     def get_results(self):
+        if self._quantized:
+            return from_millis(self._results)
         return self._results
 
+    def get_config_results(self, config_id):
+        if self._quantized:
+            return from_millis(self._results[config_id])
+        return self._results[config_id]
+
     def get_runtime_per_config(self):
         return self._runtime_per_config
 
@@ -105,30 +162,90 @@ class Environment(object):
             raise ValueError('timeout provided is too high to be simulated. timeout={}'.format(timeout))
         if instance_id is None:
             instance_id = np.random.randint(self._instance_count)
-        runtime = min(timeout, self._results[config_id][instance_id % self._instance_count])
+        measured = self._results[config_id][instance_id % self._instance_count]
+        if self._quantized:
+            measured = float('inf') if measured == TIMEOUT_SENTINEL else measured / 1000.
+        runtime = min(timeout, measured)
         self._total_runtime += runtime
         resumed_runtime = runtime - self._ran_so_far[config_id][instance_id]
         self._runtime_per_config[config_id] += resumed_runtime
         self._ran_so_far[config_id][instance_id] = runtime
         self._total_resumed_runtime += resumed_runtime
-        return timeout <= self._results[config_id][instance_id % self._instance_count], runtime, resumed_runtime
+        return timeout <= measured, runtime, resumed_runtime
+
+    def print_config_stats(self, config_id, tau=None, writer=None):
+        """Prints statistics about a particular configuration.
+
+        Also saves the runtime per config to runtime_per_config.dump, in the
+        background if an AsyncWriter is given.
+        """
 
-    def print_config_stats(self, config_id, tau=None):
-        """Prints statistics about a particular configuration."""
+        results = self.get_config_results(config_id)
 
         # Compute average runtime capped at TIMEOUT.
-        average = np.mean([min(self._timeout, r) for r in self._results[config_id]])
+        average = np.mean([min(self._timeout, r) for r in results])
         print('avg runtime capped at the dataset\'s timeout: {}'.format(average))
         timeout_count = 0
-        for t in self._results[config_id]:
+        for t in results:
             if t > self._timeout:
                 timeout_count += 1
-        print('fraction of instances timing out at the timeout of the dataset: {}'.format(float(timeout_count) / len(self._results[config_id])))
+        print('fraction of instances timing out at the timeout of the dataset: {}'.format(float(timeout_count) / len(results)))
         if tau is not None:
             timeout_count = 0
-            for t in self._results[config_id]:
+            for t in results:
                 if t > tau:
                     timeout_count += 1
-            print('fraction of instances timing out at tau: {}'.format(float(timeout_count) / len(self._results[config_id])))
-        with open('runtime_per_config.dump', 'wb') as outf:
-            pickle.dump(self._runtime_per_config, outf)
+            print('fraction of instances timing out at tau: {}'.format(float(timeout_count) / len(results)))
+        if writer is not None:
+            writer.submit('runtime_per_config.dump', self._runtime_per_config)
+        else:
+            write_pickle('runtime_per_config.dump', self._runtime_per_config)
+
+
+def add_measurement_args(parser, store=True):
+    """Adds the arguments that make_environment reads to an argparse parser.
+
+    Args:
+      parser: the argparse.ArgumentParser to add the arguments to.
+      store: whether to offer loading the measurements from a chunked store.
+    """
+    parser.add_argument('--measurements-filename', help='Filename to load measurement results from', type=str, default='measurements.dump')
+    parser.add_argument('--measurements-timeout', help='Timeout (seconds) used for the measurements', type=float, default=900.)
+    if store:
+        parser.add_argument('--measurements-store', help='Chunked store directory to load measurements from lazily, instead of --measurements-filename', type=str, default=None)
+        parser.add_argument('--cache-blocks', help='Number of measurement blocks kept in memory when using --measurements-store', type=int, default=256)
+    parser.add_argument('--quantize-measurements', help='Hold the measurements as uint32 milliseconds instead of floats, to cut memory use', action='store_true')
+
+
+def make_environment(args):
+    """Creates the environment described by the arguments added by add_measurement_args.
+
+    Args:
+      args: the parsed arguments, as a dict.
+
+    Returns:
+      A ChunkedEnvironment if a chunked store was given, otherwise an
+      Environment.
+    """
+    if args.get('measurements_store') is not None:
+        from chunked_environment import ChunkedEnvironment  # imports this module
+        return ChunkedEnvironment(args['measurements_store'], args['measurements_timeout'], args['cache_blocks'])
+    return Environment(args['measurements_filename'], args['measurements_timeout'], quantize=args['quantize_measurements'])
+
+
+def make_stop_times(total_time_budget, checkpoint_every=None):
+    """Returns the total runtimes at which the configuration procedures save their results.
+
+    Args:
+      total_time_budget: the total time (seconds) allowed.
+      checkpoint_every: if given, results are saved every this many seconds of
+        runtime, instead of at 1,2,..,9,10,50,100,150,.. CPU days.
+
+    Returns:
+      The list of stop times, in seconds.
+    """
+    if checkpoint_every is not None:
+        return list(np.arange(checkpoint_every, total_time_budget + 1, checkpoint_every))
+    step_size = int(day_in_seconds)  # CPU day, in second
+    # stop_times = list(range(step_size, 10 * int(day_in_seconds), step_size)) + list(range(10 * int(day_in_seconds), int(total_time_budget) + 1, 10 * step_size))  # check results at 1,2,3,..,9,10,20,30,... CPU days
+    return list(range(step_size, 10 * int(day_in_seconds) + 1, step_size)) + list(range(50 * int(day_in_seconds), int(total_time_budget) + 1, 50 * step_size))  # check results at 1,2,3,..,9,10,50,100,150,... CPU days
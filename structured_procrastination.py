@@ -21,12 +21,13 @@ import pickle
 import math
 import numpy as np
 import simulated_environment
+from async_writer import AsyncWriter, write_pickle
 from util import format_runtime, day_in_seconds
 
 C = 12.  # constant for l_i
 
 
-def structured_procrastination(env, n, epsilon, zeta, k0, k_bar, theta_multiplier, stop_times, deltas):
+def structured_procrastination(env, n, epsilon, zeta, k0, k_bar, theta_multiplier, stop_times, deltas, writer=None):
     """Implementation of Structured Procrastination."""
     # The names of the variables used here agree with the pseudocode in the paper,
     # except q is used instead of the paper's upper-case Q, and qq is used instead
@@ -99,14 +100,10 @@ def structured_procrastination(env, n, epsilon, zeta, k0, k_bar, theta_multiplie
         configs_r.append([(i, k[i]) for i in range(n)])
         configs_total_time.append([(i, env.get_runtime_per_config()[i]) for i in range(n)])
 
-        with open(os.path.join('results', 'results_sp_eps=' + str(epsilon) + '.p'), 'wb') as f:  # periodically save results
-            pickle.dump(results, f)
-
-        with open(os.path.join('results', 'configs_r_sp.p'), 'wb') as f:  # periodically save results
-            pickle.dump(configs_r, f)
-
-        with open(os.path.join('results', 'configs_total_time_sp.p'), 'wb') as f:  # periodically save results
-            pickle.dump(configs_total_time, f)
+        dump = writer.submit if writer is not None else write_pickle  # in the background, if given an AsyncWriter
+        dump(os.path.join('results', 'results_sp_eps=' + str(epsilon) + '.p'), results)  # periodically save results
+        dump(os.path.join('results', 'configs_r_sp.p'), configs_r)
+        dump(os.path.join('results', 'configs_total_time_sp.p'), configs_total_time)
 
     return i_star, current_delta
 
@@ -119,8 +116,7 @@ def main(epsilon, deltas):
     parser.add_argument('--k0', help='Kappa_0 from the paper', type=float, default=1.)
     parser.add_argument('--k-bar', help='bar{Kappa} from the paper', type=float, default=1000000.)
     parser.add_argument('--theta-multiplier', help='Theta multiplier from the paper', type=float, default=2.0)
-    parser.add_argument('--measurements-filename', help='Filename to load measurement results from', type=str, default='measurements.dump')
-    parser.add_argument('--measurements-timeout', help='Timeout (seconds) used for the measurements', type=float, default=900.)
+    simulated_environment.add_measurement_args(parser)
     parser.add_argument('--total-time-budget', help='Total time (seconds) allowed', type=float, default=2160000000.)  # 86400 seconds = 1 CPU day; 103680000 == 1200 CPU days
     args = vars(parser.parse_args())
 
@@ -130,15 +126,13 @@ def main(epsilon, deltas):
     k0 = args['k0']
     k_bar = args['k_bar']
     theta_multiplier = args['theta_multiplier']
-    results_file = args['measurements_filename']
-    timeout = args['measurements_timeout']
     total_time_budget = args['total_time_budget']
 
     try: os.mkdir('results')
     except OSError: pass
 
     print("creating simulated environment")
-    env = simulated_environment.Environment(results_file, timeout)
+    env = simulated_environment.make_environment(args)
     num_configs = env.get_num_configs()
 
     print("running structured_procrastination")
@@ -146,10 +140,14 @@ def main(epsilon, deltas):
     step_size = int(day_in_seconds)  # CPU day, in second
     stop_times = list(range(step_size, 10 * int(day_in_seconds), step_size)) + list(range(10 * int(day_in_seconds), int(total_time_budget) + 1, 10 * step_size))  # check results at 1,2,3,..,9,10,20,30,... CPU days
 
-    best_config_index, delta = structured_procrastination(env, num_configs, epsilon, zeta, k0, k_bar, theta_multiplier, stop_times, deltas)
+    writer = AsyncWriter()
+    try:  # the writer's thread is a daemon, so wait for the queued results even if the run fails
+        best_config_index, delta = structured_procrastination(env, num_configs, epsilon, zeta, k0, k_bar, theta_multiplier, stop_times, deltas, writer)
 
-    print('best_config_index={}, delta={}'.format(best_config_index, delta))
-    env.print_config_stats(best_config_index)
+        print('best_config_index={}, delta={}'.format(best_config_index, delta))
+        env.print_config_stats(best_config_index, writer=writer)
+    finally:
+        writer.close()
 
     print('total runtime: ' + format_runtime(env.get_total_runtime()))
     print('total resumed runtime: ' + format_runtime(env.get_total_resumed_runtime()))
@@ -172,6 +170,5 @@ if __name__ == '__main__':
                 res['epsilon'] = epsilon
                 results.append(res)
 
-    with open(os.path.join('results', 'results_sp_grid.p'), 'wb') as f:
-        pickle.dump(results, f)
+    write_pickle(os.path.join('results', 'results_sp_grid.p'), results)
 
@@ -7,20 +7,119 @@ import argparse
 import os
 import numpy as np
 import simulated_environment
-from configuration_tester import ConfigurationTester
-import pickle
+from configuration_tester import ConfigurationTester, LcbRefreshScheduler, AdaptiveLcbRefreshPolicy, IncumbentTracker, compute_confidence_bounds
+from tester_bank import TesterBank
+from run_trace import TraceRecorder, TRACE_OPTIONS
+from async_writer import AsyncWriter, write_pickle
 from util import format_runtime, day_in_seconds
 import time
 
 
-def structured_procrastination_confidence(env, n, k0, theta_multiplier, total_time_budget, stop_times):
+def save_results(results, configs_r, configs_total_time, pruned=None, writer=None):
+    """Saves the results logged so far by structured_procrastination_confidence. If an AsyncWriter is given, the
+    files are written in the background.
+    """
+    dump = writer.submit if writer is not None else write_pickle
+
+    dump(os.path.join('results', 'results_spc.p'), results)  # periodically save results
+    dump(os.path.join('results', 'configs_r_spc.p'), configs_r)
+    dump(os.path.join('results', 'configs_total_time_spc.p'), configs_total_time)
+    if pruned is not None:
+        dump(os.path.join('results', 'pruned_spc.p'), pruned)
+
+
+def prune_dominated(configs, i_star, t):
+    """Removes from <configs> every config whose lcb is above an upper confidence bound on the mean runtime of the
+    incumbent <i_star>. Both bounds are taken at a common cap, the larger of the two configs' thetas: the lcb of a
+    config bounds its mean runtime capped at its theta, and so at any larger cap too. Such configs are, with high
+    probability, worse than the incumbent at that cap, so they need not be run again. The incumbent's timed-out
+    instances still queued are counted at the cap, since their runtimes are only known to exceed the theta they ran
+    with. Returns a log entry for each pruned config.
+    """
+    incumbent = configs[i_star]
+    cids = [cid for cid in configs if cid != i_star]
+    lcbs = compute_confidence_bounds([configs[cid].runtimes for cid in cids], [configs[cid].r for cid in cids], t)
+    ucbs = {}  # by cap
+    pruned = []
+    for cid, lcb in zip(cids, lcbs.tolist()):
+        cap = max(incumbent.theta, configs[cid].theta)
+        if cap not in ucbs:
+            ucbs[cap] = incumbent._compute_upper_confidence_bound(t, cap)
+        if lcb > ucbs[cap]:
+            config = configs.pop(cid)
+            pruned.append({'iteration':t,
+                           'config':cid,
+                           'lcb':lcb,
+                           'r':config.r,
+                           'theta':config.theta,
+                           'cap':cap,
+                           'incumbent':i_star,
+                           'incumbent_ucb':ucbs[cap],
+                           'incumbent_r':incumbent.r,
+                           'incumbent_theta':incumbent.theta})
+    return pruned
+
+
+class DoublingAdmission(object):
+    """Admission schedule for streamed configs: the pool starts with <initial> configs and doubles in size each time
+    the total runtime doubles, starting at <first_time>.
+    """
+
+    def __init__(self, initial, first_time):
+        if initial < 1:
+            raise ValueError('initial must be at least 1. initial={}'.format(initial))
+        if first_time <= 0:
+            raise ValueError('first_time must be positive. first_time={}'.format(first_time))
+        self.initial = initial
+        self.first_time = first_time
+
+    def pool_size(self, time_so_far):
+        size = self.initial
+        threshold = self.first_time
+        while time_so_far >= threshold:
+            size *= 2
+            threshold *= 2
+        return size
+
+
+def random_config_stream(num_configs, seed=None):
+    """Yields the config ids 0 to num_configs - 1 in random order."""
+    for cid in np.random.RandomState(seed).permutation(num_configs):
+        yield int(cid)
+
+
+def structured_procrastination_confidence(env, n, k0, theta_multiplier, total_time_budget, stop_times, adaptive_lcb=False, prune_every=None, config_stream=None, admission=None, state=None, writer=None, on_checkpoint=None):
     """Implementation of Structured Procrastination with Confidence.
+    If adaptive_lcb is set, stable configs with lcbs well above the minimum have their lcbs refreshed less often.
+    If prune_every is set, configs dominated by the incumbent are dropped every prune_every iterations (see
+    prune_dominated) and logged to results/pruned_spc.p.
+    If config_stream is set, configs are not all created at the start: config ids are drawn from the iterator
+    config_stream whenever admission.pool_size(time_so_far) exceeds the number admitted so far, and n is ignored.
+    If state is set, it is a dict that is updated at every checkpoint with the configs and the progress of the run
+    (see warm_start). If it already holds configs, the run resumes from it: the configs are kept, any other configs
+    are admitted as usual, and stop times already reached are skipped.
+    If writer is set, results are saved in the background by that AsyncWriter.
+    If on_checkpoint is set, it is called with no arguments after the results (and state) are updated at each
+    checkpoint, e.g. to save the state.
     todo:
     """
 
     configs = {}  # configurations
-    for i in range(n):
-        configs[i] = ConfigurationTester(i, k0, theta_multiplier)
+    resumed = state is not None and 'configs' in state
+    excluded = set()  # configs pruned in the run resumed from
+    if resumed:
+        configs = state['configs']
+        excluded = set(entry['config'] for entry in state.get('pruned') or [])
+    if config_stream is None:
+        for i in range(n):
+            if i not in configs and i not in excluded:
+                configs[i] = ConfigurationTester(i, k0, theta_multiplier)
+    policy = AdaptiveLcbRefreshPolicy() if adaptive_lcb else None
+    scheduler = LcbRefreshScheduler(configs, policy)  # refreshes stale lcbs in batches
+    min_lcb = None
+    tracker = IncumbentTracker(len(configs))
+    num_admitted = len(configs)
+    runtime_per_config = env.get_runtime_per_config()
 
     time_so_far = 0
     iter_count = 0
@@ -29,13 +128,45 @@ def structured_procrastination_confidence(env, n, k0, theta_multiplier, total_ti
     results = []
     configs_r = []
     configs_total_time = []
+    pruned = [] if prune_every is not None else None
+
+    if resumed:
+        tracker = IncumbentTracker(0)
+        for cid in sorted(configs):
+            tracker.add(cid)
+            tracker.update(cid, configs[cid].r, runtime_per_config[cid])
+        time_so_far = state['time_so_far']
+        iter_count = state['iter_count']
+        results = state['results']
+        configs_r = state['configs_r']
+        configs_total_time = state['configs_total_time']
+        scheduler.num_refreshes = state.get('lcb_refreshes', 0)
+        stop_times = [stop_time for stop_time in stop_times if stop_time > time_so_far]
+        if state.get('pruned') is not None:  # kept even if this run does not prune, so pruned configs stay excluded
+            pruned = state['pruned']
 
     for stop_time in stop_times:
         while time_so_far < stop_time:
 
-            i, _ = min([(cid, config.get_confidence_bound(iter_count)) for cid, config in configs.items()], key=lambda t: t[1])
+            if config_stream is not None:
+                while num_admitted < admission.pool_size(time_so_far):
+                    cid = next(config_stream, None)
+                    if cid is None:  # every config has been admitted
+                        config_stream = None
+                        break
+                    if cid in configs or cid in excluded:  # resumed from a previous run
+                        continue
+                    configs[cid] = ConfigurationTester(cid, k0, theta_multiplier)
+                    scheduler.add(cid)
+                    tracker.add(cid)
+                    num_admitted += 1
+
+            scheduler.refresh_due(iter_count, min_lcb)
+            i, min_lcb = min([(cid, config.get_confidence_bound(iter_count)) for cid, config in configs.items()], key=lambda t: t[1])
 
             _, elapsed_time, lcb, instance_id = configs[i].execute_step(env, iter_count)
+            scheduler.executed(i)
+            tracker.update(i, configs[i].r, runtime_per_config[i])
             time_so_far += elapsed_time
 
             if iter_count % 10000 == 0:
@@ -45,8 +176,10 @@ def structured_procrastination_confidence(env, n, k0, theta_multiplier, total_ti
 
             iter_count += 1
 
-        num_actives = [(i, c.get_num_active()) for i, c in configs.items()]
-        i_star, i_star_r = max(num_actives, key=lambda t: t[1])
+            if prune_every is not None and iter_count % prune_every == 0:
+                pruned.extend(prune_dominated(configs, tracker.get_incumbent()[0], iter_count))
+
+        i_star, i_star_r = tracker.get_incumbent()
         print("------- cpu_days_so_far={}, iter_count={},  best_config_id={}, best_config_q={}, best_config_r={}, saving results -------".format(int(time_so_far / day_in_seconds), iter_count, i_star, configs[i_star].q, configs[i_star].r))
 
         results.append({'iterations':iter_count,
@@ -55,38 +188,107 @@ def structured_procrastination_confidence(env, n, k0, theta_multiplier, total_ti
                         'best_config_r':i_star_r,
                         'best_config_q':configs[i_star].q,
                         'total_runtime':time_so_far,
-                        'total_resumed_runtime':env.get_total_resumed_runtime()})
-
-        configs_r.append([(i, c.r) for i, c in configs.items()])
-        configs_total_time.append([(i, env.get_runtime_per_config()[i]) for i, _ in configs.items()])
+                        'total_resumed_runtime':env.get_total_resumed_runtime(),
+                        'lcb_refreshes':scheduler.num_refreshes,
+                        'num_admitted':num_admitted})
 
-        with open(os.path.join('results', 'results_spc.p'), 'wb') as f:  # periodically save results
-            pickle.dump(results, f)
+        configs_r.append(tracker.snapshot_r())
+        configs_total_time.append(tracker.snapshot_total_time())
 
-        with open(os.path.join('results', 'configs_r_spc.p'), 'wb') as f:  # periodically save results
-            pickle.dump(configs_r, f)
+        save_results(results, configs_r, configs_total_time, pruned, writer)
 
-        with open(os.path.join('results', 'configs_total_time_spc.p'), 'wb') as f:  # periodically save results
-            pickle.dump(configs_total_time, f)
+        if state is not None:
+            state.update({'configs':configs,
+                          'iter_count':iter_count,
+                          'time_so_far':time_so_far,
+                          'results':results,
+                          'configs_r':configs_r,
+                          'configs_total_time':configs_total_time,
+                          'lcb_refreshes':scheduler.num_refreshes,
+                          'pruned':pruned})
+        if on_checkpoint is not None:
+            on_checkpoint()
 
-    num_actives = [(i, c.get_num_active()) for i, c in configs.items()]
-    i_star, _ = max(num_actives, key=lambda t:t[1])
+    i_star, _ = tracker.get_incumbent()
 
     return i_star, configs
 
 
+def structured_procrastination_confidence_bank(env, n, k0, theta_multiplier, total_time_budget, stop_times, writer=None):
+    """Structured Procrastination with Confidence, with config state held in a TesterBank.
+    Makes the same decisions as structured_procrastination_confidence, but selects configs and refreshes stale lcbs
+    with array operations over all configs.
+    """
+
+    bank = TesterBank(n, k0, theta_multiplier)
+
+    time_so_far = 0
+    iter_count = 0
+    t0, t1 = 0, 0
+
+    results = []
+    configs_r = []
+    configs_total_time = []
+
+    for stop_time in stop_times:
+        while time_so_far < stop_time:
+
+            i = bank.argmin_confidence_bound(iter_count)
+
+            _, elapsed_time, lcb, instance_id = bank.execute_step(i, env, iter_count)
+            time_so_far += elapsed_time
+
+            if iter_count % 10000 == 0:
+                t1 = time.time()
+                print('iter_count={}, elapsed_time_since_last_print={:.0f}s, current_lcb={:3.2f}, fraction_of_time_so_far={:.5f}, current config_id={}, instance_count={}'.format(iter_count, t1 - t0, lcb, float(time_so_far) / float(total_time_budget), i, instance_id))
+                t0 = time.time()
+
+            iter_count += 1
+
+        i_star = bank.get_incumbent()
+        i_star_r = bank.get_num_active(i_star)
+        print("------- cpu_days_so_far={}, iter_count={},  best_config_id={}, best_config_q={}, best_config_r={}, saving results -------".format(int(time_so_far / day_in_seconds), iter_count, i_star, bank.q[i_star], i_star_r))
+
+        results.append({'iterations':iter_count,
+                        'best_config':i_star,
+                        'best_config_theta':float(bank.theta[i_star]),
+                        'best_config_r':i_star_r,
+                        'best_config_q':float(bank.q[i_star]),
+                        'total_runtime':time_so_far,
+                        'total_resumed_runtime':env.get_total_resumed_runtime()})
+
+        configs_r.append(list(enumerate(bank.r.tolist())))
+        runtime_per_config = env.get_runtime_per_config()
+        configs_total_time.append([(i, runtime_per_config[i]) for i in range(n)])
+
+        save_results(results, configs_r, configs_total_time, writer=writer)
+
+    return bank.get_incumbent(), bank
+
+
 def main():
     parser = argparse.ArgumentParser(description='Executes Structured Procrastination with Confidence with a simulated environment.')
     parser.add_argument('--k0', help='Kappa_0 from the paper', type=float, default=1.)
     parser.add_argument('--theta-multiplier', help='Theta multiplier from the paper', type=float, default=2.)
-    parser.add_argument('--measurements-filename', help='Filename to load measurement results from', type=str, default='measurements.dump')
-    parser.add_argument('--measurements-timeout', help='Timeout (seconds) used for the measurements', type=float, default=900.)
+    simulated_environment.add_measurement_args(parser)
+    parser.add_argument('--adaptive-lcb', help='Refresh the lcbs of stable, clearly bad configs less often', action='store_true')
+    parser.add_argument('--prune-every', help='Drop configs dominated by the incumbent every this many iterations', type=int, default=None)
+    parser.add_argument('--stream-configs', help='Admit configs in random order, starting with this many and doubling the pool each time the runtime doubles', type=int, default=None)
+    parser.add_argument('--stream-first-doubling', help='Runtime (seconds) at which the streamed pool first doubles', type=float, default=day_in_seconds)
+    parser.add_argument('--stream-seed', help='Seed for the order in which configs are streamed', type=int, default=None)
+    parser.add_argument('--tester-bank', help='Hold config state in a struct-of-arrays TesterBank', action='store_true')
+    parser.add_argument('--record-trace', help='Record every simulated run into this binary trace file (see run_trace.py)', type=str, default=None)
+    parser.add_argument('--checkpoint-every', help='Save results every this many seconds of runtime, instead of at 1,2,..,10,50,100,.. CPU days', type=float, default=None)
     parser.add_argument('--total_time_budget', help='Total time (seconds) allowed', type=float, default=24.*60.*60.*2700.)  # 2700 CPU days;
     args = vars(parser.parse_args())
+    if args['tester_bank'] and (args['stream_configs'] is not None or args['prune_every'] is not None or args['adaptive_lcb']):
+        parser.error('--stream-configs, --prune-every and --adaptive-lcb cannot be used with --tester-bank')
+    if args['stream_configs'] is not None:
+        if args['stream_configs'] < 1 or args['stream_first_doubling'] <= 0:
+            parser.error('--stream-configs must be at least 1 and --stream-first-doubling positive')
 
     k0 = args['k0']
     theta_multiplier = args['theta_multiplier']
-    results_file = args['measurements_filename']
     timeout = args['measurements_timeout']
     total_time_budget = args['total_time_budget']
 
@@ -94,18 +296,34 @@ def main():
     except OSError: pass
 
     print("creating simulated environment")
-    env = simulated_environment.Environment(results_file, timeout)
+    env = simulated_environment.make_environment(args)
+    if args['record_trace'] is not None:
+        if args['stream_configs'] is not None and args['stream_seed'] is None:
+            args['stream_seed'] = np.random.randint(2 ** 31)  # stored in the trace, so a replay streams the same configs
+        env = TraceRecorder(env, args['record_trace'], timeout, options=dict((name, args[name]) for name in TRACE_OPTIONS))
     num_configs = env.get_num_configs()
 
     print("running structured_procrastination_confidence")
 
-    step_size = int(day_in_seconds)  # CPU day, in second
-    # stop_times = list(range(step_size, 10 * int(day_in_seconds), step_size)) + list(range(10 * int(day_in_seconds), int(total_time_budget) + 1, 10 * step_size))  # check results at 1,2,3,..,9,10,20,30,... CPU days
-    stop_times = list(range(step_size, 10 * int(day_in_seconds) + 1, step_size)) + list(range(50 * int(day_in_seconds), int(total_time_budget) + 1, 50 * step_size))  # check results at 1,2,3,..,9,10,50,100,150,... CPU days
-
-    t0 = time.time()
-    best_config_index, configs = structured_procrastination_confidence(env, num_configs, k0, theta_multiplier, total_time_budget, stop_times)
-    t1 = time.time()
+    stop_times = simulated_environment.make_stop_times(total_time_budget, args['checkpoint_every'])
+
+    writer = AsyncWriter()
+    try:  # the writer's thread is a daemon, so wait for the queued results even if the run fails
+        t0 = time.time()
+        if args['tester_bank']:
+            best_config_index, configs = structured_procrastination_confidence_bank(env, num_configs, k0, theta_multiplier, total_time_budget, stop_times, writer)
+        else:
+            config_stream, admission = None, None
+            if args['stream_configs'] is not None:
+                config_stream = random_config_stream(num_configs, args['stream_seed'])
+                admission = DoublingAdmission(args['stream_configs'], args['stream_first_doubling'])
+            best_config_index, configs = structured_procrastination_confidence(env, num_configs, k0, theta_multiplier, total_time_budget, stop_times, args['adaptive_lcb'], args['prune_every'], config_stream, admission, writer=writer)
+        t1 = time.time()
+    finally:
+        writer.close()
+        if args['record_trace'] is not None:
+            env.close()
+            print('recorded {} runs to {}'.format(env.num_records, args['record_trace']))
 
     print("")
     print("for total_time_budget={}".format(total_time_budget))
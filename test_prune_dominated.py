@@ -0,0 +1,62 @@
+#
+# Copyright 2019 D R Graham
+
+import unittest
+from configuration_tester import ConfigurationTester
+from structured_procrastination_confidence import prune_dominated
+
+
+def _run(config, runtimes, t):
+    """Runs <config> on one new instance per entry of <runtimes>, timing out where the runtime is above theta."""
+    for runtime in runtimes:
+        l, theta = config.next_task()
+        config.record_result(l, theta, runtime >= theta, min(runtime, theta), t)
+
+
+class PruneDominatedTest(unittest.TestCase):
+
+    def test_incumbent_timeouts_counted_at_cap(self):
+        # The incumbent's timeouts enter its runtimes at theta=1, which understates its mean: capped at 1 it looks
+        # much faster than the challenger, whose runs all take 5s. Counted at the common cap of 8, they do not.
+        incumbent = ConfigurationTester(0, 1., 2.)
+        _run(incumbent, [0.1] * 90 + [10.] * 10, 10)
+        challenger = ConfigurationTester(1, 8., 2.)
+        _run(challenger, [5.] * 100, 10)
+        configs = {0:incumbent, 1:challenger}
+        self.assertGreater(challenger._compute_confidence_bound(10), incumbent._compute_upper_confidence_bound(10))
+
+        self.assertEqual(prune_dominated(configs, 0, 10), [])
+        self.assertEqual(sorted(configs), [0, 1])
+
+    def test_incumbent_with_timeouts_still_prunes(self):
+        incumbent = ConfigurationTester(0, 1., 2.)
+        _run(incumbent, [0.1] * 1800 + [10.] * 200, 10)
+        challenger = ConfigurationTester(1, 8., 2.)
+        _run(challenger, [5.] * 2000, 10)
+        configs = {0:incumbent, 1:challenger}
+        self.assertTrue(incumbent.Q)
+
+        pruned = prune_dominated(configs, 0, 10)
+        self.assertEqual([entry['config'] for entry in pruned], [1])
+        self.assertEqual(sorted(configs), [0])
+
+    def test_bounds_compared_at_common_cap(self):
+        incumbent = ConfigurationTester(0, 1., 2.)
+        _run(incumbent, [0.9] * 100, 10)
+        challenger = ConfigurationTester(1, 8., 2.)
+        _run(challenger, [5.] * 100, 10)
+        slow = ConfigurationTester(2, 8., 2.)
+        _run(slow, [2.] * 100, 10)
+        configs = {0:incumbent, 1:challenger, 2:slow}
+        # slow is above the incumbent's ucb capped at its own theta, but not at the challengers' theta of 8
+        self.assertGreater(slow._compute_confidence_bound(10), incumbent._compute_upper_confidence_bound(10, 1.))
+        self.assertLess(slow._compute_confidence_bound(10), incumbent._compute_upper_confidence_bound(10, 8.))
+
+        pruned = prune_dominated(configs, 0, 10)
+        self.assertEqual([entry['config'] for entry in pruned], [1])
+        self.assertEqual(pruned[0]['cap'], 8.)
+        self.assertEqual(sorted(configs), [0, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+#
+# Copyright 2019 D R Graham
+
+from collections import deque
+from math import ceil, log
+import numpy as np
+from configuration_tester import RuntimeMultiset, compute_confidence_bound, compute_confidence_bounds
+from util import millis
+
+
+class TesterBank(object):
+    """
+    Struct-of-arrays equivalent of a collection of ConfigurationTesters, one per config.
+
+    The scalar state of every config (theta, r, q, lcb, t_last_update_lcb and total_time) is held in NumPy arrays
+    indexed by config id, so that selection and bulk operations such as refreshing every stale lcb work over whole
+    arrays. The variable-size state of each config (its queue of timed out instances and its runtime multiset) is
+    held in pooled lists of compact containers.
+    """
+
+    def __init__(self, n, k0, theta_multiplier, update_lcb_every=1000):
+        """
+        Parameters:
+            n : number of configs
+            k0 : kappa 0
+            theta_multiplier : how much to increase theta by after timing out
+            update_lcb_every : only re-compute the lcb for a config if at least this many iterations have elapsed (for efficiency)
+        """
+
+        self.n = n
+        self.theta_multiplier = theta_multiplier
+        self.update_lcb_every = update_lcb_every
+
+        self.theta = np.full(n, k0, dtype=np.float64)  # current runtime caps
+        self.r = np.zeros(n, dtype=np.int64)  # number of active instances
+        self.q = np.ones(n, dtype=np.float64)
+        self.lcb = np.zeros(n, dtype=np.float64)
+        self.t_last_update_lcb = np.full(n, -1, dtype=np.int64)
+        self.total_time = np.zeros(n, dtype=np.float64)  # time spent running each configuration
+
+        self.Q = [deque() for _ in range(n)]  # double ended queue per config
+        self.runtimes = [RuntimeMultiset() for _ in range(n)]  # most recent capped runtime of each instance, per config
+
+
+    def execute_step(self, cid, env, t):
+        """
+        Execute one step of the algorithm for config <cid>. Same semantics as ConfigurationTester.execute_step.
+        """
+
+        l, theta = self.next_task(cid)
+
+        did_timeout, elapsed, resumed_elapsed = env.run(config_id=cid, timeout=theta, instance_id=l)  # get the runtime of config <cid> in instance <l>
+
+        return self.record_result(cid, l, theta, did_timeout, elapsed, t)
+
+
+    def next_task(self, cid):
+        """
+        Returns the (instance, runtime cap) to run next for config <cid>.
+        """
+        Q = self.Q[cid]
+        if len(Q) < self.q[cid]:
+            self.r[cid] += 1
+            l = int(self.r[cid])
+        else:
+            l, theta = Q.pop()
+            self.theta[cid] = theta
+
+        return l, float(self.theta[cid])
+
+
+    def record_result(self, cid, l, theta, did_timeout, elapsed, t, update_lcb=True):
+        """
+        Updates the state of config <cid> with the outcome of running instance <l> with runtime cap <theta>. If
+        update_lcb is False, the caller is responsible for re-computing the lcb of <cid> at iteration t.
+        """
+        if did_timeout:
+            rt = theta
+            self.Q[cid].appendleft((l, self.theta_multiplier * theta))
+        else:
+            rt = elapsed
+
+        rt = np.round(rt, decimals=3)  # round to milliseconds
+
+        self.total_time[cid] += rt
+
+        runtimes = self.runtimes[cid]
+        runtimes.update(l, millis(rt))
+
+        r = int(self.r[cid])
+        if update_lcb:
+            self.lcb[cid] = compute_confidence_bound(runtimes, r, t)
+            self.t_last_update_lcb[cid] = t
+
+        if r <= 1 or t <= 1:
+            self.q[cid] = 25.
+        else:
+            self.q[cid] = ceil(25. * log(t * log(r, 2), 2))
+
+        return did_timeout, rt, float(self.lcb[cid]), len(runtimes)
+
+
+    def get_confidence_bound(self, cid, t):
+        """
+        Returns the lcb for config <cid>, re-computing it as necessary.
+        """
+        if t - self.t_last_update_lcb[cid] > self.update_lcb_every:
+            self.lcb[cid] = compute_confidence_bound(self.runtimes[cid], int(self.r[cid]), t)
+            self.t_last_update_lcb[cid] = t
+        return float(self.lcb[cid])
+
+
+    def refresh_stale_lcbs(self, t):
+        """
+        Re-computes the lcb of every config whose lcb has not been updated in more than update_lcb_every iterations.
+        Returns the number of configs refreshed.
+        """
+        stale = np.nonzero(t - self.t_last_update_lcb > self.update_lcb_every)[0]
+        if len(stale):
+            self.lcb[stale] = compute_confidence_bounds([self.runtimes[cid] for cid in stale], self.r[stale].tolist(), t)
+            self.t_last_update_lcb[stale] = t
+        return len(stale)
+
+
+    def argmin_confidence_bound(self, t):
+        """
+        Returns the id of the config with the smallest lcb, after refreshing stale lcbs. Ties go to the smallest id,
+        as for min() over a dict of ConfigurationTesters.
+        """
+        self.refresh_stale_lcbs(t)
+        return int(np.argmin(self.lcb))
+
+
+    def get_num_active(self, cid):
+        """
+        Returns the number of active instances for config <cid>.
+        """
+        return int(self.r[cid])
+
+
+    def get_incumbent(self):
+        """
+        Returns the id of the config with the most active instances. Ties go to the smallest id.
+        """
+        return int(np.argmax(self.r))
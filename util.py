@@ -17,4 +17,35 @@ def ecdf(vals, x, eps=1e-12):
 
 def format_runtime(runtime):
     """ """
-    return '{}s = {}m = {}h = {}d'.format(runtime, runtime / 60, runtime / 3600, runtime / (3600 * 24))
\ No newline at end of file
+    return '{}s = {}m = {}h = {}d'.format(runtime, runtime / 60, runtime / 3600, runtime / (3600 * 24))
+
+TIMEOUT_SENTINEL = np.iinfo(np.uint32).max  # encodes a runtime above the measurement timeout
+
+
+def to_millis(runtimes, timeout=None):
+    """
+    Encode runtimes in seconds as integer milliseconds (uint32). Runtimes above timeout are encoded as TIMEOUT_SENTINEL.
+    Runtimes are rounded down, so a runtime reaches a cap of a whole number of milliseconds exactly when its encoding does,
+    and runs time out as they would on the unencoded runtimes. Products within 1e-6 ms below a whole millisecond are
+    taken as that millisecond, so that float error does not shift runtimes that are already whole milliseconds.
+    """
+    millis = np.floor(np.round(np.asarray(runtimes, dtype=np.float64) * 1000., 6))
+    if timeout is not None:
+        millis[np.asarray(runtimes) > timeout] = TIMEOUT_SENTINEL
+    return np.minimum(millis, TIMEOUT_SENTINEL).astype(np.uint32)
+
+
+def from_millis(millis):
+    """
+    Decode integer milliseconds to runtimes in seconds. TIMEOUT_SENTINEL decodes to infinity.
+    """
+    millis = np.asarray(millis)
+    seconds = millis / 1000.
+    return np.where(millis == TIMEOUT_SENTINEL, np.inf, seconds)
+
+
+def millis(rt):
+    """
+    Integer milliseconds of a single runtime in seconds.
+    """
+    return int(round(rt * 1000.))
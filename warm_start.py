@@ -0,0 +1,178 @@
+#!/usr/bin/python
+#
+# Copyright 2019 D R Graham
+
+import argparse
+import os
+import pickle
+import time
+import simulated_environment
+from async_writer import write_pickle
+from structured_procrastination_confidence import structured_procrastination_confidence
+from util import format_runtime
+
+
+def save_spc_state(path, state, env, instance_keys=None):
+    """Saves the state of a run of structured_procrastination_confidence, for warm-starting a later run. The file is
+    replaced atomically, so it may be the one the run was warm-started from.
+
+    Args:
+      path: file to write the state to.
+      state: the state dict passed to structured_procrastination_confidence.
+      env: the Environment the run used.
+      instance_keys: names of the instances of env, by position. Defaults to
+        those of a state returned by load_spc_state, or else the positions
+        themselves.
+    """
+    if instance_keys is None:
+        instance_keys = state.get('instance_keys')
+    if instance_keys is None:
+        instance_keys = list(range(env.get_num_instances()))
+    write_pickle(path, {'spc':state,
+                        'env':env.get_state(),
+                        'config_keys':list(env.get_config_keys()),
+                        'instance_keys':list(instance_keys)})
+
+
+def _map_pairs(pairs, config_map):
+    return [(config_map[cid], value) for cid, value in pairs if cid in config_map]
+
+
+def load_spc_state(path, env, instance_keys=None):
+    """Loads a state saved by save_spc_state onto a new Environment, whose configs and instances may differ.
+
+    Configs are matched by their keys in the measurements files. Configs that are no longer measured are dropped;
+    new configs are admitted by structured_procrastination_confidence as usual. Instances are matched by
+    <instance_keys>, or by position if not given. The instances of env are reordered so that every instance of the
+    previous run keeps its position, with new instances after them, so the testers' instance ids stay valid. The
+    runtime accounting of env is restored, so that the run continues as if it had not been interrupted.
+
+    Args:
+      path: file written by save_spc_state.
+      env: the Environment to continue on. It must not have been run yet.
+      instance_keys: names of the instances of env, by position.
+
+    Environment.run takes instance ids modulo the number of instances. A config of the previous run that used every
+    instance has ids that wrapped around; these are renamed, along with the runtime accounting of env, so that they
+    still refer to the instance they ran on once the number of instances grows.
+
+    Raises:
+      ValueError: if an instance of the previous run is not in env.
+
+    Returns:
+      The state dict to pass to structured_procrastination_confidence, which also holds the instance names of env
+      by their new positions.
+    """
+    with open(path, 'rb') as f:
+        saved = pickle.load(f)
+
+    # Instances of the previous run keep their positions; new instances are appended.
+    if instance_keys is None:
+        instance_keys = list(range(env.get_num_instances()))
+    positions = dict((key, j) for j, key in enumerate(instance_keys))
+    order = []
+    for key in saved['instance_keys']:
+        if key not in positions:
+            raise ValueError('instance {} of the previous run is not in the new measurements'.format(key))
+        order.append(positions.pop(key))
+    order.extend(sorted(positions.values()))
+    env.reorder_instances(order)
+
+    # Id l ran on instance l % num_saved_instances, which keeps its position; renamed so that ids stay distinct and
+    # are still taken to that position modulo the new number of instances.
+    num_saved_instances = len(saved['instance_keys'])
+    num_instances = env.get_num_instances()
+
+    def remap(l):
+        return l % num_saved_instances + num_instances * (l // num_saved_instances)
+
+    new_config_ids = dict((key, cid) for cid, key in enumerate(env.get_config_keys()))
+    config_map = dict((cid, new_config_ids[key]) for cid, key in enumerate(saved['config_keys']) if key in new_config_ids)
+
+    spc = saved['spc']
+    configs = {}
+    for cid, config in spc['configs'].items():
+        if cid in config_map:
+            config.cid = config_map[cid]
+            if config.r >= num_saved_instances:
+                config.remap_instances(remap)
+            configs[config.cid] = config
+
+    env_state = saved['env']
+    env.set_state({'total_runtime':env_state['total_runtime'],
+                   'total_resumed_runtime':env_state['total_resumed_runtime'],
+                   'runtime_per_config':dict((config_map[cid], t) for cid, t in env_state['runtime_per_config'].items() if cid in config_map),
+                   'ran_so_far':dict((config_map[cid], dict((remap(l), t) for l, t in ran.items())) for cid, ran in env_state['ran_so_far'].items() if cid in config_map)})
+
+    results = []
+    for entry in spc['results']:
+        entry = dict(entry)
+        entry['best_config'] = config_map.get(entry['best_config'])  # None if the config is no longer measured
+        results.append(entry)
+    pruned = None
+    if spc.get('pruned') is not None:
+        pruned = [dict(entry, config=config_map[entry['config']], incumbent=config_map.get(entry['incumbent'])) for entry in spc['pruned'] if entry['config'] in config_map]
+
+    print('warm start: kept {} of {} configs and {} instances; {} new configs and {} new instances'.format(
+        len(configs), len(spc['configs']), len(saved['instance_keys']), env.get_num_configs() - len(configs), env.get_num_instances() - len(saved['instance_keys'])))
+
+    return {'configs':configs,
+            'iter_count':spc['iter_count'],
+            'time_so_far':spc['time_so_far'],
+            'results':results,
+            'configs_r':[_map_pairs(pairs, config_map) for pairs in spc['configs_r']],
+            'configs_total_time':[_map_pairs(pairs, config_map) for pairs in spc['configs_total_time']],
+            'lcb_refreshes':spc.get('lcb_refreshes', 0),
+            'instance_keys':[instance_keys[j] for j in order],
+            'pruned':pruned}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Executes Structured Procrastination with Confidence, continuing from the state of a previous run.')
+    parser.add_argument('--previous-state', help='State file saved by a previous run to continue from; starts from scratch if not given', type=str, default=None)
+    parser.add_argument('--save-state', help='File to save the state of this run to at every checkpoint', type=str, default='spc_state.p')
+    parser.add_argument('--instance-keys', help='Pickle file with the list of instance names of the measurements, by position; instances are matched by position if not given', type=str, default=None)
+    parser.add_argument('--k0', help='Kappa_0 from the paper', type=float, default=1.)
+    parser.add_argument('--theta-multiplier', help='Theta multiplier from the paper', type=float, default=2.)
+    simulated_environment.add_measurement_args(parser, store=False)  # the warm start reorders the instances in memory
+    parser.add_argument('--prune-every', help='Drop configs dominated by the incumbent every this many iterations', type=int, default=None)
+    parser.add_argument('--checkpoint-every', help='Save results every this many seconds of runtime, instead of at 1,2,..,10,50,100,.. CPU days', type=float, default=None)
+    parser.add_argument('--total_time_budget', help='Total time (seconds) allowed, including the time of previous runs', type=float, default=24.*60.*60.*2700.)  # 2700 CPU days;
+    args = vars(parser.parse_args())
+
+    total_time_budget = args['total_time_budget']
+
+    try: os.mkdir('results')
+    except OSError: pass
+
+    instance_keys = None
+    if args['instance_keys'] is not None:
+        with open(args['instance_keys'], 'rb') as f:
+            instance_keys = pickle.load(f)
+
+    print("creating simulated environment")
+    env = simulated_environment.make_environment(args)
+    num_configs = env.get_num_configs()
+
+    state = {}
+    if args['previous_state'] is not None:
+        state = load_spc_state(args['previous_state'], env, instance_keys)
+        instance_keys = state['instance_keys']  # by position after reordering
+
+    stop_times = simulated_environment.make_stop_times(total_time_budget, args['checkpoint_every'])
+
+    print("running structured_procrastination_confidence")
+    t0 = time.time()
+    best_config_index, _ = structured_procrastination_confidence(env, num_configs, args['k0'], args['theta_multiplier'], total_time_budget, stop_times, prune_every=args['prune_every'], state=state,
+                                                                 on_checkpoint=lambda: save_spc_state(args['save_state'], state, env, instance_keys))
+    t1 = time.time()
+
+    print("")
+    print('best_config_index={}'.format(best_config_index))
+    print('total runtime: ' + format_runtime(env.get_total_runtime()))
+    print('total resumed runtime: ' + format_runtime(env.get_total_resumed_runtime()))
+    print("Total real time to run: {}".format(t1 - t0))
+
+
+if __name__ == '__main__':
+    main()